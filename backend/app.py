@@ -1,190 +1,497 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, g, jsonify, request, url_for
 from flask_cors import CORS
 import json
 import subprocess
 import sys
+import os
 from pathlib import Path
-from climbr_branching import run_branching_simulation
+from apark_timeline import patient2
+from clinical_path import release_model_state
+from result_cache import MEMORY_CACHE_MAX_BYTES, MEMORY_CACHE_RUNS, MemoryLRU, ResultCache, simulation_key
+from payloads import (build_pathways_payload, build_predictions_payload, build_sampled_predictions_payload,
+                      build_sampling_payload, build_tree_payload, iter_tree_ndjson)
+from timelines import parse_cohort
+from batch_simulation import simulate_cohort
+from jobs import JobManager, KeyedLock, SingleFlight
+from profiling import metrics, span, start_collecting, stop_collecting, timing_block
+from model_client import MODEL_SERVER, ModelClient
+from settings import MODEL_ID, MODEL_PRECISION
+import gzip
+import time
+import zlib
 import json
 
-with open("loinc.json", "r") as f:
-    loinc = json.load(f)
-with open("cpt4.json", "r") as f:
-    cpt4 = json.load(f)
-with open("snomed.json", "r") as f:
-    snomed = json.load(f)
 app = Flask(__name__)
 CORS(app)
-cached_paths = None
-cached_initial_patient = None
+# Worker processes for uncached simulations; 1 runs them in the request's own process
+SIMULATION_PROCESSES = int(os.environ.get("SIMULATION_PROCESSES", 1))
+# Search shapes are client-controlled, so their cost is capped: at most this many children
+# per node, and at most this many open paths per level. Searches that could outgrow the
+# frontier cap without a ?max_frontier= get it as their max_frontier
+MAX_BRANCHING = int(os.environ.get("PATHWAY_MAX_BRANCHING", 16))
+MAX_FRONTIER = int(os.environ.get("PATHWAY_MAX_FRONTIER", 256))
+# Simulation results keyed by simulation_key(): (paths, initial_patient). The on-disk
+# store is shared by every worker and survives restarts; `cached_runs` saves re-reading the
+# most recently used ones. Keys come from client-controlled parameters, so both are bounded
+result_cache = ResultCache()
+cached_runs = MemoryLRU(max_entries=MEMORY_CACHE_RUNS)
+# Serialized JSON bodies keyed by (endpoint, simulation key), built once per simulation;
+# gzipped copies are stored under (endpoint, simulation key, 'gzip')
+cached_responses = MemoryLRU(max_bytes=MEMORY_CACHE_MAX_BYTES, size=len)
+# Smaller bodies aren't worth compressing
+GZIP_MIN_BYTES = 1024
+# Gzipped NDJSON streams are flushed to the client every this many lines
+NDJSON_FLUSH_LINES = 16
+job_manager = JobManager()
+# Concurrent misses for the same key wait on one simulation instead of each running the model
+simulation_flights = SingleFlight()
+# With MODEL_SERVER set, model work runs in model_server.py and this process never loads torch
+model_client = ModelClient() if MODEL_SERVER else None
+# Extensions rewrite model state on the nodes they share with the tree they grow from; only
+# trees grown from the same search share nodes, so each search's extensions are serialized
+extension_locks = KeyedLock()
+metrics.describe('climbr_http_requests_total', "API requests by endpoint and status")
+metrics.describe('climbr_http_request_seconds', "End-to-end API request latency")
+metrics.describe('climbr_simulations_total', "Simulation lookups by where the result came from "
+                 "(shared: waited on a concurrent request's run)")
+
+if os.environ.get("PRELOAD_MODEL") and model_client is None:
+    # Load and warm up the model at startup instead of on the first cache miss
+    from model_registry import get_model
+    get_model(MODEL_ID)
+
+
+@app.before_request
+def _start_timing():
+    g.request_start = time.perf_counter()
+    g.stages, g.stages_token = start_collecting()
+
+
+@app.after_request
+def _record_timing(response):
+    """Update request metrics and, with ?debug=1, add the per-stage `timing` block to JSON bodies"""
+    elapsed = time.perf_counter() - g.request_start
+    labels = {'endpoint': request.endpoint or 'unknown', 'method': request.method,
+              'status': str(response.status_code)}
+    metrics.inc('climbr_http_requests_total', labels)
+    metrics.observe('climbr_http_request_seconds', elapsed, labels)
+    if (request.args.get('debug') and response.is_json and not response.is_streamed
+            and 'Content-Encoding' not in response.headers):
+        payload = response.get_json()
+        if isinstance(payload, dict):
+            payload['timing'] = timing_block(g.stages, elapsed)
+            response.set_data(app.json.dumps(payload))
+    return response
+
+
+@app.teardown_request
+def _stop_timing(exc=None):
+    token = g.pop('stages_token', None)
+    if token is not None:
+        stop_collecting(token)
+
+
+def _search_params():
+    """Read the beam search shape from the query string"""
+    params = (
+        request.args.get('depth', 4, type=int),
+        request.args.get('branching', 2, type=int),
+        request.args.get('min_prob', 0.0, type=float),
+        request.args.get('max_frontier', None, type=int),
+    )
+    depth, branching, min_prob, max_frontier = params
+    if depth < 1 or branching < 1 or (max_frontier is not None and max_frontier < 1):
+        raise ValueError("depth, branching and max_frontier must be positive")
+    if branching > MAX_BRANCHING:
+        raise ValueError(f"branching can be at most {MAX_BRANCHING}")
+    if max_frontier is not None and max_frontier > MAX_FRONTIER:
+        raise ValueError(f"max_frontier can be at most {MAX_FRONTIER}")
+    if max_frontier is None and _frontier_bound(branching, depth) > MAX_FRONTIER:
+        max_frontier = MAX_FRONTIER
+    return depth, branching, min_prob, max_frontier
+
+
+def _frontier_bound(branching, levels, width=1):
+    """Open paths after `levels` levels of `branching` from `width` paths, stopping once past MAX_FRONTIER"""
+    for _ in range(levels):
+        if width > MAX_FRONTIER:
+            break
+        width *= branching
+    return width
+
+
+def _check_extensions(search, extensions):
+    """Refuse extension lists that would grow the tree past the search caps.
+
+    With a max_frontier every deepened level is pruned to it anyway; without one, the
+    open paths the extensions could add up to are counted against MAX_FRONTIER.
+    """
+    width = _frontier_bound(search['branching'], search['depth'])
+    for extension in extensions:
+        if extension.get('op') == 'deepen':
+            branching = int(extension.get('branching', search['branching']))
+            levels = int(extension.get('levels', 1))
+            if branching < 1 or levels < 1:
+                raise ValueError("deepen levels and branching must be positive")
+            if branching > MAX_BRANCHING:
+                raise ValueError(f"branching can be at most {MAX_BRANCHING}")
+            width = _frontier_bound(branching, levels, width)
+        elif extension.get('op') == 'widen':
+            extra = int(extension.get('extra', 1))
+            if extra < 1 or extra > MAX_BRANCHING:
+                raise ValueError(f"widen extra must be between 1 and {MAX_BRANCHING}")
+            width += extra
+        if search['max_frontier'] is None and width > MAX_FRONTIER:
+            raise ValueError(f"The extensions grow the tree past {MAX_FRONTIER} open paths per level; "
+                             f"search with a max_frontier to extend it this far")
+
+
+def _simulation_key(params, events=patient2):
+    """Cache key and run_branching_simulation() kwargs for a parsed search"""
+    depth, branching, min_cum_prob, max_frontier = params
+    search = {'depth': depth, 'branching': branching, 'min_cum_prob': min_cum_prob, 'max_frontier': max_frontier}
+    return simulation_key(events, MODEL_ID, search, MODEL_PRECISION), search
+
+
+def _get_simulation(key, search, on_level=None):
+    """Return (paths, initial_patient) for this search, running the model on a miss.
+
+    `on_level(level, paths)` is only called when the model actually runs. Concurrent
+    misses for one key share a single run (see `simulation_flights`).
+    """
+    result = cached_runs.get(key)
+    if result is not None:
+        metrics.inc('climbr_simulations_total', {'source': 'memory'})
+        return result
+
+    def simulate():
+        result = cached_runs.get(key)
+        if result is not None:  # Finished between the check above and joining the flight
+            return result
+        result = result_cache.get(key)
+        metrics.inc('climbr_simulations_total', {'source': 'disk' if result is not None else 'model'})
+        if result is None:
+            # Imported here so cache hits never load torch
+            if model_client is not None:
+                result = model_client.simulate(patient2, search)
+            elif SIMULATION_PROCESSES > 1 and search['max_frontier'] is None:
+                from parallel_search import run_parallel_simulation
+                result = run_parallel_simulation(initial_patient=patient2, model_id=MODEL_ID, on_level=on_level,
+                                                 processes=SIMULATION_PROCESSES, **search)
+            else:
+                from climbr_branching import run_branching_simulation
+                result = run_branching_simulation(initial_patient=patient2, model_id=MODEL_ID, on_level=on_level, **search)
+            release_model_state(result[0])  # Cached trees don't hold on to KV caches
+            result_cache.put(key, *result)
+        cached_runs.put(key, result)
+        return result
+
+    result, shared = simulation_flights.do(key, simulate)
+    if shared:
+        metrics.inc('climbr_simulations_total', {'source': 'shared'})
+    return result
+
+
+def _sampling_params():
+    """Read the Monte Carlo rollout settings from the query string"""
+    params = {
+        'n_samples': request.args.get('samples', 256, type=int),
+        'max_length': request.args.get('max_length', 8, type=int),
+        'temperature': request.args.get('temperature', 1.0, type=float),
+        'seed': request.args.get('seed', 0, type=int),
+    }
+    if params['n_samples'] < 1 or params['max_length'] < 1 or params['temperature'] <= 0:
+        raise ValueError("samples, max_length and temperature must be positive")
+    return params
+
+
+def _sampling_key(params, events=patient2):
+    """Cache key for a set of rollouts; `mode` keeps it apart from every search key"""
+    return simulation_key(events, MODEL_ID, dict(params, mode='sample'), MODEL_PRECISION)
+
+
+def _get_sampling(key, params):
+    """Return (trajectories, initial_patient) for these rollout settings, sampling on a miss.
+
+    Rollouts are cheap next to a deep search and only kept in memory.
+    """
+    result = cached_runs.get(key)
+    if result is not None:
+        metrics.inc('climbr_simulations_total', {'source': 'memory'})
+        return result
+
+    def sample():
+        result = cached_runs.get(key)
+        if result is not None:
+            return result
+        metrics.inc('climbr_simulations_total', {'source': 'model'})
+        if model_client is not None:
+            result = model_client.sample(patient2, params)
+        else:
+            from sampling import run_monte_carlo_simulation
+            result = run_monte_carlo_simulation(initial_patient=patient2, model_id=MODEL_ID, **params)
+        cached_runs.put(key, result)
+        return result
+
+    result, shared = simulation_flights.do(key, sample)
+    if shared:
+        metrics.inc('climbr_simulations_total', {'source': 'shared'})
+    return result
+
+
+def _apply_extension(paths, initial_patient, search, extension):
+    """Run one {"op": "deepen" | "widen", ...} step on a tree"""
+    if model_client is not None:
+        return model_client.extend(paths, initial_patient, search, extension)
+    from climbr_branching import apply_extension
+    return apply_extension(paths, initial_patient, search, extension, model_id=MODEL_ID)
+
+
+def _cached_extension(keys):
+    """(steps, tree) for the longest prefix of an extension list that is cached, else (0, None)"""
+    for i in range(len(keys) - 1, 0, -1):
+        result = cached_runs.get(keys[i]) or result_cache.get(keys[i])
+        if result is not None:
+            return i, result
+    return 0, None
+
+
+def _extended_simulation(key, search, extensions):
+    """(paths, initial_patient) for the search with `extensions` applied in order.
+
+    Each prefix of the extension list is cached like a search of its own, so only the
+    steps past the longest cached prefix run the model.
+    """
+    keys = [key] + [simulation_key(patient2, MODEL_ID, dict(search, extensions=extensions[:i + 1]), MODEL_PRECISION)
+                    for i in range(len(extensions))]
+    done, result = _cached_extension(keys)
+    if result is None:
+        result = _get_simulation(key, search)  # Outside the lock: a cold search can take a while
+    with extension_locks.hold(key):
+        if done < len(extensions):
+            # Another request may have run more of these steps while this one waited
+            more, cached = _cached_extension(keys)
+            if more > done:
+                done, result = more, cached
+        paths, initial_patient = result
+        try:
+            for i in range(done, len(extensions)):
+                paths = _apply_extension(paths, initial_patient, search, extensions[i])
+                result_cache.put(keys[i + 1], paths, initial_patient)
+                cached_runs.put(keys[i + 1], (paths, initial_patient))
+        finally:
+            # Later steps reuse the state the earlier ones left; cached trees keep none of it.
+            # The tree only ever grows, so its final nodes include every earlier one
+            release_model_state(paths)
+        return paths, initial_patient
+
+
+def _pathways_builder():
+    """Payload builder for the requested ?format= of pathway trees"""
+    pathway_format = request.args.get('format', 'paths')
+    if pathway_format == 'paths':
+        return build_pathways_payload
+    if pathway_format == 'tree':
+        return build_tree_payload
+    raise ValueError(f"Unknown format {pathway_format!r}, expected 'paths', 'tree' or 'ndjson'")
+
+
+def _accepts_gzip():
+    # ?debug=1 adds the timing block to the JSON body, which a compressed body can't take
+    return 'gzip' in request.headers.get('Accept-Encoding', '') and not request.args.get('debug')
+
+
+def _cached_response(endpoint, build_payload, sampled=False):
+    """Serve the endpoint's JSON for the requested search (or, when `sampled`, rollouts),
+    serializing (and gzipping) it once per simulation"""
+    if sampled:
+        params = _sampling_params()
+        key = _sampling_key(params)
+    else:
+        key, search = _simulation_key(_search_params())
+    body = cached_responses.get((endpoint, key))
+    if body is None:
+        result, initial_patient = _get_sampling(key, params) if sampled else _get_simulation(key, search)
+        with span('build_payload'):
+            payload = build_payload(result, initial_patient)
+        with span('serialize'):
+            body = app.json.dumps(payload)
+        cached_responses.put((endpoint, key), body)
+
+    if len(body) < GZIP_MIN_BYTES or not _accepts_gzip():
+        return app.response_class(body, mimetype=app.json.mimetype)
+    compressed = cached_responses.get((endpoint, key, 'gzip'))
+    if compressed is None:
+        with span('compress'):
+            compressed = gzip.compress(body.encode('utf-8'), compresslevel=6)
+        cached_responses.put((endpoint, key, 'gzip'), compressed)
+    response = app.response_class(compressed, mimetype=app.json.mimetype)
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def _ndjson_response():
+    """Stream the normalized tree as NDJSON, gzipped on the fly when the client accepts it"""
+    key, search = _simulation_key(_search_params())
+    current_paths, initial_patient = _get_simulation(key, search)
+    lines = iter_tree_ndjson(current_paths, initial_patient, app.json.dumps)
+    headers = {'Vary': 'Accept-Encoding'}
+    if _accepts_gzip():
+        def compressed(lines):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+            for count, line in enumerate(lines, 1):
+                chunk = compressor.compress(line.encode('utf-8'))
+                if count % NDJSON_FLUSH_LINES == 0:
+                    # Without a sync flush zlib holds everything back until the end
+                    chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+                if chunk:
+                    yield chunk
+            yield compressor.flush()
+
+        lines = compressed(lines)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(lines, mimetype='application/x-ndjson', headers=headers)
+
+
 @app.route('/api/pathways', methods=['GET'])
 def get_pathways():
-    """Run the CLMBR model and return the pathway results"""
+    """Run the CLMBR model and return the pathway results.
+
+    ?format=paths (default) lists every pathway with its full steps; ?format=tree sends
+    each node once with a parent pointer, and ?format=ndjson streams that tree line by line.
+    """
     try:
-        
-        # Parse the output to extract pathway data
-        # This assumes you modify climbr_branching.py to output JSON at the end
-        # Or you can parse the current_paths variable directly if imported
-        
-        # For now, we'll import and run the model directly
-
-        
-        # Convert the paths to JSON-serializable format
-        pathways_data = []
-        global cached_paths, cached_initial_patient
-        if cached_paths is None:
-            cached_paths, cached_initial_patient = run_branching_simulation()
-        current_paths = cached_paths
-        initial_patient = cached_initial_patient
-        for path in current_paths:
-            pathway = {
-                'id': path.path_id,
-                'parent_id': path.parent_id,
-                'diagnosis_found': path.diagnosis_found,
-                'final_diagnosis': path.final_diagnosis,
-                'steps': []
-            }
-            
-            for step in path.steps:
-                # Parse the token to get system and code
-                token = step['token']
-                system = token.split('/')[0] if '/' in token else 'Unknown'
-                code = token.split('/', 1)[1] if '/' in token else token
-                code_only = code.split('/')[-1].split(" ")[0] if '/' in code else code
-                display_name = code  # Default to showing the code
-                if system == 'LOINC' and code_only in loinc:
-                    if not loinc[code_only]["DisplayName"]:
-                        display_name = loinc[code_only]["LONG_COMMON_NAME"]
-                    else:
-                        display_name = loinc[code_only]["DisplayName"]
-                if system == 'CPT4' and code_only in cpt4:
-                    display_name = cpt4[code_only]
-                if system == 'SNOMED' and code_only in snomed:
-                    display_name = snomed[code_only]
-                pathway['steps'].append({
-                    'token': token,
-                    'system': system,
-                    'code': display_name,
-                    'fullcode': code,
-                    'probability': step['probability'],
-                    'type': step['type']
-                })
-            
-            pathways_data.append(pathway)
-        
-        # Get initial patient data
-        initial_data = []
-        for event in initial_patient:
-            system = event.code.split('/')[0] if '/' in event.code else 'Unknown'
-            code_only = event.code.split('/')[-1].split(" ")[0] if '/' in event.code else event.code
-            display_name = event.code  # Default to showing the code
-            if system == 'LOINC' and code_only in loinc:
-                if not loinc[code_only]["DisplayName"]:
-                    display_name = loinc[code_only]["LONG_COMMON_NAME"]
-                else:
-                    display_name = loinc[code_only]["DisplayName"]
-            if system == 'CPT4' and code_only in cpt4:
-                display_name = cpt4[code_only]
-            if system == 'SNOMED' and code_only in snomed:
-                display_name = snomed[code_only]
-            initial_data.append({
-                'code': event.code,
-                'name': display_name,
-                'system': system,
-                'value': event.value,
-                'omop_table': event.omop_table
-            })
-        
-        return jsonify({
-            'initial_patient': initial_data,
-            'pathways': pathways_data,
-            'total_paths': len(pathways_data),
-            'paths_with_diagnosis': sum(1 for p in pathways_data if p['diagnosis_found'])
-        })
-        
+        if request.args.get('format') == 'ndjson':
+            return _ndjson_response()
+        build_payload = _pathways_builder()
+        return _cached_response(f"pathways:{request.args.get('format', 'paths')}", build_payload)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/predictions', methods=['GET'])
 def get_predictions():
-    """Get most frequent codes across all pathways"""
+    """Get most frequent codes across all pathways.
+
+    With ?mode=sample the codes are ranked by the share of Monte Carlo rollouts that
+    contain them instead (see /api/sampling for the rollout parameters).
+    """
     try:
-        from collections import Counter
-        
-        # Use cached paths if available
-        global cached_paths
-        if cached_paths is None:
-            cached_paths, _ = run_branching_simulation()
-        current_paths = cached_paths
-        
-        # Track unique code positions to avoid double-counting
-        # Key: (level, branch_index, step_number), Value: code
-        unique_code_positions = {}
-        
-        # Process each path
-        for path in current_paths:
-            # Parse path ID to understand its position in the tree
-            path_parts = path.path_id.split('-')
-            if len(path_parts) >= 2:
-                level = int(path_parts[1]) if path_parts[1].isdigit() else 4
-                path_index = int(path_parts[2]) if len(path_parts) > 2 and path_parts[2].isdigit() else 0
-            else:
-                level = 4
-                path_index = 0
-            
-            # Track codes by their position in the branching structure
-            for step_idx, step in enumerate(path.steps):
-                if step_idx == 0:
-                    # First step - 8 paths share each code
-                    position_key = (1, path_index // 8, 0)
-                elif step_idx == 1:
-                    # Second step - 4 paths share each code
-                    position_key = (2, path_index // 4, 0)
-                elif step_idx == 2:
-                    # Third step - 2 paths share each code
-                    position_key = (3, path_index // 2, 0)
-                elif step_idx == 3:
-                    # Fourth step - unique to each path
-                    position_key = (4, path_index, 0)
-                else:
-                    # Any additional steps
-                    position_key = (4, path_index, step_idx)
-                
-                # Store the code at this position
-                unique_code_positions[position_key] = step['token']
-        
-        # Count unique codes
-        code_counter = Counter(unique_code_positions.values())
-        total_positions = len(unique_code_positions)
-        
-        # Convert to predictions format
-        predictions = []
-        for code, count in code_counter.most_common(10):
-            percentage = (count / total_positions) * 100
-            system = code.split('/')[0] if '/' in code else 'Unknown'
-            code_only = code.split('/')[-1].split(" ")[0] if '/' in code else code
-            display_name = code  # Default to showing the code
-            if system == 'LOINC' and code_only in loinc:
-                if not loinc[code_only]["DisplayName"]:
-                    display_name = loinc[code_only]["LONG_COMMON_NAME"]
-                else:
-                    display_name = loinc[code_only]["DisplayName"]
-            if system == 'CPT4' and code_only in cpt4:
-                display_name = cpt4[code_only]
-            if system == 'SNOMED' and code_only in snomed:
-                display_name = snomed[code_only]
-            predictions.append({
-                'name': display_name,  # Truncate long codes
-                'probability': round(percentage, 1),
-                'code':code,
-                'system': system,
-                'count': count
-            })
-        
-        return jsonify({'predictions': predictions})
-        
+        mode = request.args.get('mode', 'tree')
+        if mode == 'sample':
+            return _cached_response('predictions:sample', build_sampled_predictions_payload, sampled=True)
+        if mode != 'tree':
+            raise ValueError(f"Unknown mode {mode!r}, expected 'tree' or 'sample'")
+        return _cached_response('predictions', build_predictions_payload)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/sampling', methods=['GET'])
+def get_sampling():
+    """Estimate the distribution of final diagnoses from Monte Carlo rollouts.
+
+    ?samples= trajectories (256) each sample up to ?max_length= events (8) at
+    ?temperature= (1.0), seeded by ?seed= (0); estimates carry 95% Wilson intervals.
+    """
+    try:
+        return _cached_response('sampling', build_sampling_payload, sampled=True)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/pathways/extend', methods=['POST'])
+def extend_pathways():
+    """Grow the tree of the requested search without rebuilding it.
+
+    Body: {"extensions": [{"op": "deepen", "levels": 1, "node_id": optional},
+                          {"op": "widen", "node_id": ..., "extra": 1}, ...]}
+    applied in order; deepening without a node_id grows every leaf.
+    """
+    try:
+        key, search = _simulation_key(_search_params())
+        extensions = (request.get_json(force=True) or {}).get('extensions', [])
+        if not isinstance(extensions, list) or not all(isinstance(extension, dict) for extension in extensions):
+            raise ValueError("extensions must be a list of objects")
+        _check_extensions(search, extensions)
+        build_payload = _pathways_builder()
+        current_paths, initial_patient = _extended_simulation(key, search, extensions)
+        with span('build_payload'):
+            payload = build_payload(current_paths, initial_patient)
+        return jsonify(dict(payload, extensions=extensions))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cohort', methods=['POST'])
+def post_cohort():
+    """Run the branching search for every patient in the posted cohort (see timelines.parse_cohort)"""
+    try:
+        _, search = _simulation_key(_search_params())
+        cohort = parse_cohort(request.get_json(force=True))
+        results = simulate_cohort(cohort, search, model_id=MODEL_ID, result_cache=result_cache,
+                                  batch_size=request.args.get('batch_size', 64, type=int),
+                                  processes=SIMULATION_PROCESSES, client=model_client)
+        return jsonify({
+            'patients': {patient_id: build_pathways_payload(paths, events)
+                         for patient_id, (paths, events) in results.items()},
+            'total_patients': len(results)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['POST'])
+def start_job():
+    """Start a simulation in the background; poll it or stream its levels as they complete"""
+    try:
+        key, search = _simulation_key(_search_params())
+        build_payload = _pathways_builder()
+
+        def run(report_level):
+            reported = []
+
+            def on_level(level, current_paths):
+                reported.append(level)
+                report_level(dict(build_payload(current_paths, patient2), level=level))
+
+            current_paths, initial_patient = _get_simulation(key, search, on_level=on_level)
+            if not reported:
+                # Served from cache: stream the finished tree as a single level
+                report_level(dict(build_payload(current_paths, initial_patient), level=search['depth']))
+
+        # Level payloads depend on the format, so jobs for different formats don't merge
+        job = job_manager.submit(f"{key}:{request.args.get('format', 'paths')}", run)
+        return jsonify(dict(job.to_dict(),
+                            status_url=url_for('get_job', job_id=job.job_id),
+                            stream_url=url_for('stream_job', job_id=job.job_id))), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status of a background simulation"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    """Server-sent events: one `level` event per completed tree level, then `done` or `error`"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+
+    def generate():
+        for event, data in job.stream():
+            if event == 'ping':
+                yield ": ping\n\n"
+            else:
+                yield f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of request, stage and simulation metrics"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    app.run(debug=True, port=5000)
@@ -0,0 +1,119 @@
+"""Run the branching simulation for whole cohorts.
+
+    python batch_simulation.py cohort.jsonl more_patients.json --depth 4 --output pathways.jsonl
+    python batch_simulation.py --store store/ --depth 4
+
+Inputs are .json, .jsonl or OMOP-style .csv timelines (see `timelines.load_timelines`), or
+a pre-tokenized `token_store` directory. Results go to the
+shared result cache, so the API serves them without running the model, and optionally
+to a JSONL file with one /api/pathways-style payload per patient.
+"""
+from hf_ehr.config import Event
+from typing import Dict, List, Optional, Tuple
+from result_cache import ResultCache, simulation_key
+from timelines import load_timelines
+from payloads import build_pathways_payload
+from model_client import ModelClient
+from token_store import TokenStore
+from settings import MODEL_ID, MODEL_PRECISION
+import argparse
+import json
+import time
+
+
+def simulate_cohort(cohort: Dict[str, List[Event]], search: Dict, model_id: str = MODEL_ID,
+                    result_cache: Optional[ResultCache] = None, batch_size: Optional[int] = 64,
+                    workers: int = 1, processes: int = 1, threads_per_process: Optional[int] = None,
+                    client: Optional[ModelClient] = None, store: Optional[TokenStore] = None
+                    ) -> Dict[str, Tuple[list, List[Event]]]:
+    """Return {patient_id: (paths, events)}, running the model only for patients missing from the cache.
+
+    With `processes` > 1 the missing patients are shared out over a pool of worker
+    processes (see parallel_search) instead of running in this one; with a `client` they
+    run on its model server. With a token `store`, `cohort` is `store.cohort(...)` and
+    histories are read pre-tokenized; cache keys then hash the stored tokens.
+    """
+    if store is not None and client is not None:
+        raise ValueError("A token store can't be used with a model server client")
+    results = {}
+    missing = {}
+    for patient_id, events in cohort.items():
+        if store is not None:
+            key = simulation_key([], model_id, dict(search, tokens=store.digest(patient_id)), MODEL_PRECISION)
+        else:
+            key = simulation_key(events, model_id, search, MODEL_PRECISION)
+        cached = result_cache.get(key) if result_cache is not None else None
+        if cached is not None:
+            results[patient_id] = cached
+        else:
+            missing[patient_id] = key
+
+    if missing:
+        # Imported here so fully cached cohorts never load torch
+        patients = {patient_id: cohort[patient_id] for patient_id in missing}
+        if client is not None:
+            ran = client.simulate_cohort(patients, search)
+        elif processes > 1:
+            from parallel_search import run_parallel_cohort
+            ran = run_parallel_cohort(patients, model_id=model_id, processes=processes,
+                                      threads_per_process=threads_per_process, batch_size=batch_size,
+                                      store=store, **search)
+        else:
+            from climbr_branching import run_cohort_simulation
+            ran = run_cohort_simulation(patients, model_id=model_id, batch_size=batch_size, workers=workers,
+                                        store=store, **search)
+        for patient_id, result in ran.items():
+            if result_cache is not None:
+                result_cache.put(missing[patient_id], *result)
+            results[patient_id] = result
+
+    return {patient_id: results[patient_id] for patient_id in cohort}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-compute pathway trees for a cohort of patient timelines")
+    parser.add_argument('inputs', nargs='*', help=".json, .jsonl or OMOP-style .csv patient timelines")
+    parser.add_argument('--store', help="Simulate the patients of this token store (see token_store.py)")
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--branching', type=int, default=2)
+    parser.add_argument('--min-prob', type=float, default=0.0)
+    parser.add_argument('--max-frontier', type=int, default=None)
+    parser.add_argument('--model', default=MODEL_ID, help="Hub id or local checkpoint directory")
+    parser.add_argument('--batch-size', type=int, default=64, help="Rows per forward pass, across patients")
+    parser.add_argument('--workers', type=int, default=1, help="Forward passes run concurrently")
+    parser.add_argument('--processes', type=int, default=1, help="Worker processes, each with its own model copy")
+    parser.add_argument('--threads-per-process', type=int, default=None,
+                        help="Torch threads per worker process (default: cores / processes)")
+    parser.add_argument('--output', help="Write one JSON record per patient to this .jsonl file")
+    parser.add_argument('--no-cache', action='store_true', help="Neither read nor fill the result cache")
+    args = parser.parse_args()
+    if bool(args.inputs) == bool(args.store):
+        parser.error("give either timeline inputs or --store")
+
+    store = TokenStore(args.store) if args.store else None
+    cohort = store.cohort() if store is not None else {}
+    for path in args.inputs:
+        for patient_id, events in load_timelines(path).items():
+            if patient_id in cohort:
+                raise ValueError(f"Duplicate patient id {patient_id} in {path}")
+            cohort[patient_id] = events
+
+    search = {'depth': args.depth, 'branching': args.branching,
+              'min_cum_prob': args.min_prob, 'max_frontier': args.max_frontier}
+    start = time.perf_counter()
+    results = simulate_cohort(cohort, search, model_id=args.model,
+                              result_cache=None if args.no_cache else ResultCache(),
+                              batch_size=args.batch_size, workers=args.workers,
+                              processes=args.processes, threads_per_process=args.threads_per_process,
+                              store=store)
+    print(f"Simulated {len(results)} patients in {time.perf_counter() - start:.1f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for patient_id, (paths, events) in results.items():
+                record = dict(build_pathways_payload(paths, events), patient_id=patient_id)
+                f.write(json.dumps(record) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""Benchmark the branching simulator and the API against a tiny stand-in model.
+
+    python benchmark.py --lengths 50 200 800 --depth 4 --output bench.json
+
+A randomly initialized GPT-2 with a CLMBR tokenizer over a synthetic vocabulary is
+written to a local checkpoint directory (nothing is downloaded), so the numbers measure
+this code rather than the real model's weights. Reports model-load time, per-level
+forward-pass latency, tokens per second, peak RSS, response serialization time and
+end-to-end request latency as JSON, so runs can be compared across commits.
+"""
+from hf_ehr.config import Event
+from typing import Dict, List, Optional
+from pathlib import Path
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from apark_timeline import patient2
+from mbishop_timeline import patient1
+
+SYSTEMS = ('LOINC', 'SNOMED', 'RxNorm', 'CPT4')
+# LOINC codes get two numeric ranges each, like CLMBR's lab value buckets
+VALUE_RANGES = [(0, 80), (80, 1000)]
+
+
+def build_stand_in_model(directory: str, n_codes: int = 2000, n_layer: int = 2, n_embd: int = 64,
+                         n_positions: int = 1024, seed: int = 0) -> List[str]:
+    """Write a random GPT-2 checkpoint plus tokenizer_config.json to `directory`.
+
+    The vocabulary holds every code of patient1/patient2 plus `n_codes` synthetic ones;
+    returns the codes so timelines can be drawn from them.
+    """
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+    from hf_ehr.data.tokenization import CLMBRTokenizer
+
+    rng = random.Random(seed)
+    codes = sorted(set(event.code for event in patient1 + patient2))
+    while len(codes) < n_codes + len(set(event.code for event in patient1 + patient2)):
+        code = f"{rng.choice(SYSTEMS)}/{rng.randint(1000, 999999)}"
+        if code not in codes:
+            codes.append(code)
+
+    entries = []
+    for code in codes:
+        entries.append({'code': code, 'type': 'code', 'tokenization': {}, 'stats': []})
+        if code.startswith('LOINC/'):
+            for start, end in VALUE_RANGES:
+                entries.append({'code': code, 'type': 'numerical_range', 'stats': [],
+                                'tokenization': {'unit': None, 'range_start': start, 'range_end': end}})
+    os.makedirs(directory, exist_ok=True)
+    config_path = os.path.join(directory, 'tokenizer_config.json')
+    with open(config_path, 'w') as f:
+        json.dump({'metadata': {}, 'tokens': entries}, f)
+
+    tokenizer = CLMBRTokenizer(config_path)
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=len(tokenizer), n_embd=n_embd, n_layer=n_layer, n_head=2, n_positions=n_positions)
+    GPT2LMHeadModel(config).save_pretrained(directory)
+    return codes
+
+
+def synthetic_timeline(codes: List[str], length: int, seed: int = 0) -> List[Event]:
+    """`length` events drawn from `codes`; LOINC events carry a numeric value"""
+    rng = random.Random(seed)
+    events = []
+    for i in range(length):
+        code = rng.choice(codes)
+        value = round(rng.uniform(0, 200), 1) if code.startswith('LOINC/') else None
+        start = f"2024-01-{1 + i // 1440 % 28:02d}T{i // 60 % 24:02d}:{i % 60:02d}:00.000Z"
+        events.append(Event(code=code, value=value, unit=None, start=start, end=None, omop_table=None))
+    return events
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+class ForwardRecorder:
+    """Times every forward pass of a model and counts the tokens it ran"""
+    def __init__(self, model):
+        self.records: List[Dict] = []
+        self._start = None
+        self._hooks = [
+            model.register_forward_pre_hook(self._before, with_kwargs=True),
+            model.register_forward_hook(self._after, with_kwargs=True),
+        ]
+
+    def _before(self, module, args, kwargs):
+        self._start = time.perf_counter()
+
+    def _after(self, module, args, kwargs, output):
+        input_ids = kwargs.get('input_ids', args[0] if args else None)
+        attention_mask = kwargs.get('attention_mask')
+        tokens = input_ids.numel()
+        if attention_mask is not None:
+            tokens = int(attention_mask[:, -input_ids.shape[-1]:].sum())  # Padding excluded
+        self.records.append({'seconds': time.perf_counter() - self._start, 'rows': input_ids.shape[0],
+                             'tokens': tokens})
+
+    def remove(self):
+        for hook in self._hooks:
+            hook.remove()
+
+
+def _summary(samples: List[float]) -> Dict:
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'mean_ms': 1000 * statistics.mean(samples),
+        'p50_ms': 1000 * statistics.median(samples),
+        'p95_ms': 1000 * samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+        'max_ms': 1000 * samples[-1],
+    }
+
+
+def bench_simulation(handle, events: List[Event], depth: int, branching: int) -> Dict:
+    """One run_branching_simulation call with per-level forward-pass timings"""
+    from climbr_branching import run_branching_simulation, tokenize_history
+
+    recorder = ForwardRecorder(handle.model)
+    level_marks = []
+
+    def on_level(level, paths):
+        level_marks.append((level, time.perf_counter(), len(recorder.records), len(paths)))
+
+    start = time.perf_counter()
+    try:
+        run_branching_simulation(depth=depth, branching=branching, initial_patient=events, handle=handle,
+                                 on_level=on_level)
+    finally:
+        recorder.remove()
+    total = time.perf_counter() - start
+
+    levels = []
+    previous_time, previous_record = start, 0
+    for level, mark_time, record_count, n_paths in level_marks:
+        records = recorder.records[previous_record:record_count]
+        forward_s = sum(record['seconds'] for record in records)
+        tokens = sum(record['tokens'] for record in records)
+        levels.append({
+            'level': level,
+            'paths': n_paths,
+            'seconds': mark_time - previous_time,
+            'forward_passes': len(records),
+            'rows': sum(record['rows'] for record in records),
+            'forward_s': forward_s,
+            'tokens': tokens,
+            'tokens_per_s': tokens / forward_s if forward_s else None,
+        })
+        previous_time, previous_record = mark_time, record_count
+
+    forward_s = sum(record['seconds'] for record in recorder.records)
+    tokens = sum(record['tokens'] for record in recorder.records)
+    return {
+        'timeline_events': len(events),
+        'history_tokens': len(tokenize_history(events, handle.tokenizer, handle.context)[0]),
+        'total_s': total,
+        'forward_s': forward_s,
+        'tokens': tokens,
+        'tokens_per_s': tokens / forward_s if forward_s else None,
+        'levels': levels,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def bench_api(repeat: int, depth: int, branching: int) -> Dict:
+    """Latency of /api/pathways and /api/predictions from cold, disk-cached and memory-cached state"""
+    import app as app_module
+    from distribution_cache import distribution_cache
+    from payloads import build_pathways_payload, build_predictions_payload
+
+    client = app_module.app.test_client()
+    query = f"?depth={depth}&branching={branching}"
+    results = {}
+    for endpoint, build_payload in (('pathways', build_pathways_payload), ('predictions', build_predictions_payload)):
+        url = f"/api/{endpoint}{query}"
+
+        # Cold: nothing cached anywhere, the model runs inside the request
+        for path in app_module.result_cache.directory.glob('*.json.gz'):
+            path.unlink()
+        app_module.cached_runs.clear()
+        app_module.cached_responses.clear()
+        distribution_cache.clear()
+        start = time.perf_counter()
+        response = client.get(url)
+        cold = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} returned {response.status_code}: {response.get_data(as_text=True)}")
+
+        # Disk: a fresh worker with a warm result cache
+        disk = []
+        for _ in range(repeat):
+            app_module.cached_runs.clear()
+            app_module.cached_responses.clear()
+            start = time.perf_counter()
+            client.get(url)
+            disk.append(time.perf_counter() - start)
+
+        # Memory: the serialized body is already built
+        memory = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            client.get(url)
+            memory.append(time.perf_counter() - start)
+
+        # Serialization alone, on the simulation the requests used
+        key, search = app_module._simulation_key((depth, branching, 0.0, None))
+        paths, initial_patient = app_module._get_simulation(key, search)
+        build, dump = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            payload = build_payload(paths, initial_patient)
+            build.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            body = app_module.app.json.dumps(payload)
+            dump.append(time.perf_counter() - start)
+
+        results[endpoint] = {
+            'cold_ms': 1000 * cold,
+            'disk_cache': _summary(disk),
+            'memory_cache': _summary(memory),
+            'build_payload': _summary(build),
+            'json_dumps': _summary(dump),
+            'response_bytes': len(body),
+        }
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the branching simulator and API on a stand-in model")
+    parser.add_argument('--lengths', type=int, nargs='+', default=[50, 200, 800], help="Synthetic timeline lengths")
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--branching', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=20, help="Samples per cached-request measurement")
+    parser.add_argument('--layers', type=int, default=2, help="Stand-in model layers")
+    parser.add_argument('--embd', type=int, default=64, help="Stand-in model width")
+    parser.add_argument('--codes', type=int, default=2000, help="Synthetic vocabulary size")
+    parser.add_argument('--model-dir', help="Reuse or create the stand-in checkpoint here")
+    parser.add_argument('--skip-api', action='store_true')
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='climbr-bench-')
+    model_dir = args.model_dir or os.path.join(workdir, 'model')
+    n_positions = max(1024, 2 * max(args.lengths) + args.depth + 16)
+    codes = build_stand_in_model(model_dir, n_codes=args.codes, n_layer=args.layers, n_embd=args.embd,
+                                 n_positions=n_positions)
+    # The app reads these at import; point it at the stand-in model and a throwaway cache
+    os.environ['CLMBR_MODEL_ID'] = model_dir
+    os.environ['PATHWAY_CACHE_DIR'] = os.path.join(workdir, 'cache')
+
+    import torch
+    import transformers
+    from model_registry import get_model
+
+    start = time.perf_counter()
+    handle = get_model(model_dir)
+    model_load_s = time.perf_counter() - start
+
+    report = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'transformers': transformers.__version__,
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'platform': platform.platform(),
+        },
+        'config': vars(args),
+        'model_load_s': model_load_s,
+        'simulations': [bench_simulation(handle, synthetic_timeline(codes, length, seed=length), args.depth,
+                                         args.branching)
+                        for length in args.lengths],
+    }
+    if not args.skip_api:
+        report['api'] = bench_api(args.repeat, args.depth, args.branching)
+    from distribution_cache import distribution_cache
+    report['distribution_cache'] = distribution_cache.stats()
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    shutil.rmtree(workdir, ignore_errors=True)  # --model-dir checkpoints live outside it
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
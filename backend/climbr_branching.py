@@ -1,153 +1,548 @@
-
-from transformers import AutoModelForCausalLM
-from hf_ehr.data.tokenization import CLMBRTokenizer
 from hf_ehr.config import Event
-from typing import List, Dict, Optional, Tuple
+from typing import Callable, List, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import torch
-import copy
 from apark_timeline import patient2
 from mbishop_timeline import patient1
-def run_branching_simulation():
-    print("Loading model...")
-    model = AutoModelForCausalLM.from_pretrained("YaHi/gpt_clmbr")
-    tokenizer = CLMBRTokenizer.from_pretrained("YaHi/gpt_clmbr")
-    # Initial patient history
-    initial_patient = patient2
-
-    class ClinicalPath:
-        """Represents a single diagnostic pathway"""
-        def __init__(self, events: List[Event], path_id: str, parent_id: str = None):
-            self.events = copy.deepcopy(events)
-            self.path_id = path_id
-            self.parent_id = parent_id
-            self.diagnosis_found = False
-            self.final_diagnosis = None
-            self.steps = []  # Track the journey from initial patient state
-            
-        def add_event(self, token_text: str, probability: float):
-            """Add a new event to this path"""
-            # Parse the token to create an Event
-            if '/' in token_text:
-                system, code = token_text.split('/', 1)
-                
-                # Determine the table based on the system
-                if system == 'LOINC':
-                    omop_table = 'measurement'
-                elif system == 'RxNorm':
-                    omop_table = 'drug_exposure'
-                elif system == 'SNOMED':
-                    # Could be condition or observation
-                    omop_table = 'condition_occurrence' if 'condition' in token_text.lower() else 'observation'
-                elif system == 'CPT4':
-                    omop_table = 'procedure_occurrence'
-                else:
-                    omop_table = 'observation'
-                
-                new_event = Event(
-                    code=token_text,
-                    value=f"Predicted: {token_text}",
-                    unit=None,
-                    start='2025-08-23T14:00:00.000Z',
-                    end=None,
-                    omop_table=omop_table
-                )
-                
-                self.events.append(new_event)
-                self.steps.append({
-                    'token': token_text,
-                    'probability': probability,
-                    'type': omop_table
-                })
-                
-                # Check if this is a diagnosis (condition_occurrence)
-                if omop_table == 'condition_occurrence':
-                    self.diagnosis_found = True
-                    self.final_diagnosis = token_text
-
-    def get_next_tokens(patient_events: List[Event], model, tokenizer, n_tokens: int = 2) -> List[Tuple[str, float]]:
-        """Get top n predictions for next token given patient history"""
+from clinical_path import ClinicalPath
+from profiling import span
+from distribution_cache import distribution_cache, extend_sequence_hash, history_hash
+from context_window import ContextWindow
+from model_registry import MODEL_ID, ModelHandle, VocabularyFilter, get_model, inference_context
+
+
+def _model_inputs(input_ids: torch.Tensor, tokenizer) -> Dict[str, torch.Tensor]:
+    """Build model kwargs matching what `tokenizer(...)` returns for the same ids"""
+    inputs = {'input_ids': input_ids}
+    if 'token_type_ids' in tokenizer.model_input_names:
+        inputs['token_type_ids'] = torch.zeros_like(input_ids)
+    return inputs
+
+
+def _as_legacy_cache(past_key_values):
+    """Per-layer (key, value) tuples for either cache format"""
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _split_suffix(patient_events: List[Event], tokenizer) -> Tuple[List[int], List[int]]:
+    with span('tokenize'):
         batch = tokenizer([patient_events], add_special_tokens=True, return_tensors='pt')
-        
-        with torch.no_grad():
-            outputs = model(**batch)
+    input_ids = batch['input_ids'][0].tolist()
+    if input_ids and input_ids[-1] == tokenizer.eos_token_id:
+        return input_ids[:-1], input_ids[-1:]
+    return input_ids, []
+
+
+def fit_history(patient_events: List[Event], tokenizer, context: Optional[ContextWindow] = None
+                ) -> Tuple[List[int], List[int], Dict]:
+    """`tokenize_history` plus a report of how much of the history `context` left out"""
+    events = patient_events
+    if context is not None:
+        with span('truncate'):
+            events = context.select(patient_events, tokenizer)
+    history_ids, suffix_ids = _split_suffix(events, tokenizer)
+    capped = False
+    if context is not None and len(history_ids) > context.budget:
+        # Leading special tokens count against the budget too; select once more, leaving room for them
+        overflow = len(history_ids) - context.budget
+        with span('truncate'):
+            events = context.select(patient_events, tokenizer,
+                                    max(1, context.count_tokens(events, tokenizer) - overflow))
+        history_ids, suffix_ids = _split_suffix(events, tokenizer)
+        capped_ids = context.cap(history_ids, tokenizer)
+        capped = len(capped_ids) < len(history_ids)
+        history_ids = capped_ids
+    report = {
+        'strategy': context.strategy if context is not None else None,
+        'events_total': len(patient_events),
+        'events_kept': len(events),
+        'tokens_kept': len(history_ids),
+        'truncated': len(events) < len(patient_events) or capped,
+    }
+    if context is not None:
+        context.record(report)
+    return history_ids, suffix_ids, report
+
+
+def tokenize_history(patient_events: List[Event], tokenizer,
+                     context: Optional[ContextWindow] = None) -> Tuple[List[int], List[int]]:
+    """Tokenize a patient history, split into (history ids, trailing special ids).
+
+    The tokenizer closes every sequence with `[EOS]`, so the next-token distribution is
+    read after it. Keeping those trailing ids apart lets appended events be run on top of
+    the cached history and still see the same input layout as a full re-tokenization.
+    With a `context` window, histories too long for the model are cut first.
+    """
+    history_ids, suffix_ids, _ = fit_history(patient_events, tokenizer, context)
+    return history_ids, suffix_ids
+
+
+def _history(patient_events: List[Event], handle: ModelHandle) -> Tuple[List[int], List[int], str]:
+    """(history ids, suffix ids, root sequence hash) of a patient under the handle's context window"""
+    history_ids, suffix_ids, report = fit_history(patient_events, handle.tokenizer, handle.context)
+    codes = [event.code for event in patient_events] if report['truncated'] else None
+    return history_ids, suffix_ids, history_hash(history_ids, codes)
+
+
+def root_path(patient_events: List[Event], handle: ModelHandle, history_ids=None,
+              suffix_ids: Optional[List[int]] = None) -> Tuple[ClinicalPath, List[int]]:
+    """The "Path-0" root of a patient's tree, its history still to be run; returns (root, suffix ids).
+
+    `history_ids` (e.g. from a `token_store.TokenStore`) are used as they are instead of
+    tokenizing `patient_events`; only the context window's hard cap applies to them.
+    """
+    root = ClinicalPath(patient_events, "Path-0")
+    if history_ids is None:
+        history_ids, suffix_ids, sequence_hash = _history(patient_events, handle)
+    else:
+        history_ids = [int(token_id) for token_id in history_ids]
+        capped = handle.context.cap(history_ids, handle.tokenizer) if handle.context is not None else history_ids
+        sequence_hash = history_hash(capped, [event.code for event in patient_events]
+                                     if len(capped) < len(history_ids) else None)
+        history_ids = capped
+        suffix_ids = list(suffix_ids or [])
+    root.set_token_ids(history_ids)
+    root.sequence_hash = sequence_hash
+    return root, suffix_ids
+
+
+def check_context(handle: ModelHandle, levels: int):
+    """Predicted events have to fit in the positions the context window holds back for them"""
+    if handle.context is not None and levels >= handle.context.reserve:
+        raise ValueError(f"{levels} predicted events don't fit in the {handle.context.reserve} positions "
+                         f"reserved for them (CLMBR_CONTEXT_RESERVE)")
+
+
+def _pack_batch(paths: List[ClinicalPath], tokenizer, suffix_ids: List[int]):
+    """Padded (past_key_values, input_ids, attention_mask, position_ids) for `score_paths`"""
+    caches = [_as_legacy_cache(path.past_key_values) for path in paths]
+    cache_lengths = [0 if cache is None else cache[0][0].shape[-2] for cache in caches]
+    # Whatever the cache doesn't cover yet: the path's own token, or more when ancestors weren't run
+    new_ids = [path.tail_ids(path.sequence_length - cache_length) + suffix_ids
+               for path, cache_length in zip(paths, cache_lengths)]
+    max_cache = max(cache_lengths)
+    max_new = max(len(ids) for ids in new_ids)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    input_ids = torch.tensor([[pad_id] * (max_new - len(ids)) + ids for ids in new_ids])
+    attention_mask = torch.zeros(len(paths), max_cache + max_new, dtype=torch.long)
+    position_ids = torch.zeros(len(paths), max_new, dtype=torch.long)
+    for row, (cache_length, ids) in enumerate(zip(cache_lengths, new_ids)):
+        attention_mask[row, max_cache - cache_length:max_cache] = 1
+        attention_mask[row, max_cache + max_new - len(ids):] = 1
+        position_ids[row, max_new - len(ids):] = torch.arange(cache_length, cache_length + len(ids))
+
+    past_key_values = None
+    if max_cache > 0:
+        template = next(cache for cache in caches if cache is not None)
+        layers = []
+        for layer_idx, layer in enumerate(template):
+            tensors = []
+            for t_idx, t in enumerate(layer):
+                rows = []
+                for cache, cache_length in zip(caches, cache_lengths):
+                    shape = (1,) + t.shape[1:-2] + (max_cache - cache_length, t.shape[-1])
+                    padding = t.new_zeros(shape)
+                    rows.append(padding if cache is None else torch.cat([padding, cache[layer_idx][t_idx]], dim=-2))
+                tensors.append(torch.cat(rows, dim=0))
+            layers.append(tuple(tensors))
+        past_key_values = tuple(layers)
+        original = next(path.past_key_values for path in paths if path.past_key_values is not None)
+        if hasattr(original, 'to_legacy_cache'):
+            past_key_values = type(original).from_legacy_cache(past_key_values)
+    return past_key_values, input_ids, attention_mask, position_ids
+
+
+def score_paths(paths: List[ClinicalPath], model, tokenizer, suffix_ids: List[int],
+                inference_mode: bool = False) -> torch.Tensor:
+    """Return next-token probabilities for every path in one batched forward pass.
+
+    Each row only runs the tokens past its cached prefix (plus the trailing special
+    tokens). Rows are left-padded on the cache side and padded between cache and new
+    tokens when lengths differ; padding is masked out and position ids are kept per row, so
+    every row sees exactly what it would see on its own. Afterwards `path.past_key_values`
+    covers the whole path and can be handed to its children.
+    """
+    with span('pack_batch'):
+        past_key_values, input_ids, attention_mask, position_ids = _pack_batch(paths, tokenizer, suffix_ids)
+
+    with inference_context(inference_mode):
+        with span('forward'):
+            outputs = model(**_model_inputs(input_ids, tokenizer), attention_mask=attention_mask,
+                            position_ids=position_ids, past_key_values=past_key_values, use_cache=True)
             logits = outputs.logits
-        
-        next_token_logits = logits[0, -1, :]
-        next_token_probs = torch.softmax(next_token_logits, dim=-1)
-        
-        # Get top candidates to find meaningful tokens
-        top_k = 100
-        top_probs, top_indices = torch.topk(next_token_probs, min(top_k, len(next_token_probs)))
-        
+
+        # Keep each row's real positions, minus the trailing special tokens
+        with span('kv_cache'):
+            batch_cache = _as_legacy_cache(outputs.past_key_values)
+            for row, path in enumerate(paths):
+                keep = attention_mask[row].nonzero().squeeze(-1)
+                keep = keep[:len(keep) - len(suffix_ids)]
+                path.past_key_values = tuple(
+                    tuple(t[row:row + 1].index_select(-2, keep) for t in layer) for layer in batch_cache
+                )
+
+        # Softmax in fp32 even when the model runs in half precision
+        with span('softmax'):
+            next_token_logits = logits[:, -1, :].float()
+            return torch.softmax(next_token_logits, dim=-1)
+
+
+def select_next_tokens_batch(next_token_probs: torch.Tensor, events_per_row: List[List[Event]], vocab: VocabularyFilter,
+                             n_tokens: int = 2) -> List[List[Tuple[str, float, int]]]:
+    """Pick the top n valid, not yet present medical codes for each row of a probability batch"""
+    with span('filter'):
+        masks = torch.stack([vocab.candidate_mask(events) for events in events_per_row])
+        masked_probs = next_token_probs.masked_fill(~masks, -1.0)
+    with span('topk'):
+        top_probs, top_indices = torch.topk(masked_probs, min(n_tokens, masked_probs.shape[-1]), dim=-1)
+
         predictions = []
-        for i in range(len(top_indices)):
-            token_id = top_indices[i].item()
-            probability = top_probs[i].item()
-            
-            try:
-                if hasattr(tokenizer, 'decode'):
-                    token_text = tokenizer.decode([token_id])
-                elif hasattr(tokenizer, 'convert_ids_to_tokens'):
-                    token_text = tokenizer.convert_ids_to_tokens([token_id])[0]
-                else:
-                    continue
-                
-                # Skip special tokens and domain markers
-                if (token_text == "Domain/OMOP generated" or 
-                    token_text.startswith("Domain/") or 
-                    token_text.startswith("Visit/") or
-                    token_text in ['<pad>', '<unk>', '<s>', '</s>']):
-                    continue
-                
-                # Only include medical codes with proper format
-                if '/' in token_text and any(token_text.startswith(prefix) for prefix in ['LOINC/', 'SNOMED/', 'RxNorm/', 'CPT4/']):
-                    # Check if this token already exists in the patient events
-                    already_exists = any(event.code == token_text[:len(event.code)] for event in patient_events)
-                    if not already_exists:
-                        predictions.append((token_text, probability))
-                        if len(predictions) >= n_tokens:
-                            break
-                            
-            except Exception as e:
-                continue
-        
-        return predictions
+        for row_probs, row_indices in zip(top_probs.tolist(), top_indices.tolist()):
+            predictions.append([
+                (vocab.id_to_text[token_id], probability, token_id)
+                for probability, token_id in zip(row_probs, row_indices)
+                if probability >= 0  # Fewer than n allowed candidates left
+            ])
+    return predictions
+
+
+def score_frontier(frontier: List[ClinicalPath], handle: ModelHandle, suffix_ids: List[int], branching: int = 2,
+                   batched: bool = True, batch_size: Optional[int] = None,
+                   workers: int = 1) -> List[List[Tuple[str, float, int]]]:
+    """Next-event predictions for every path in `frontier`.
+
+    Batched mode packs up to `batch_size` paths (all of them by default) into each forward
+    pass; paths may come from different patients. With `workers` > 1 the batches run
+    concurrently on a thread pool.
+
+    Paths whose token sequence was scored before (for at least `branching` candidates)
+    take their predictions from the distribution cache and skip the model; their
+    children then run those paths' tokens along with their own.
+    """
+    keys = [None] * len(frontier)
+    results = [None] * len(frontier)
+    if distribution_cache.max_entries > 0:
+        namespace = f"{handle.model_id}:{handle.precision}"
+        for idx, path in enumerate(frontier):
+            if path.sequence_hash is not None:
+                keys[idx] = f"{namespace}:{path.sequence_hash}"
+                results[idx] = distribution_cache.get(keys[idx], branching)
+    misses = [idx for idx, predictions in enumerate(results) if predictions is None]
+    if not misses:
+        return results
+
+    to_score = [frontier[idx] for idx in misses]
+    if not batched:
+        batch_size = 1
+    batch_size = batch_size or len(to_score)
+    batches = [to_score[i:i + batch_size] for i in range(0, len(to_score), batch_size)]
+
+    def score_batch(batch: List[ClinicalPath]) -> List[List[Tuple[str, float, int]]]:
+        probs = score_paths(batch, handle.model, handle.tokenizer, suffix_ids, handle.inference_mode)
+        return select_next_tokens_batch(probs, [path.events for path in batch], handle.vocab, n_tokens=branching)
+
+    if workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scored = list(executor.map(score_batch, batches))
+    else:
+        scored = [score_batch(batch) for batch in batches]
+    for idx, predictions in zip(misses, (row for batch_predictions in scored for row in batch_predictions)):
+        results[idx] = predictions
+        if keys[idx] is not None:
+            distribution_cache.put(keys[idx], branching, predictions)
+    return results
+
+
+def grow_level(current_paths: List[ClinicalPath], level: int, handle: Optional[ModelHandle], suffix_ids: List[int],
+               branching: int = 2, min_cum_prob: float = 0.0, batched: bool = True,
+               frontier_predictions: Optional[List[List[Tuple[str, float, int]]]] = None,
+               id_offset: int = 0) -> Tuple[List[ClinicalPath], List[ClinicalPath]]:
+    """Give every open path up to `branching` children; returns (next paths, new children).
+
+    This is one level of `expand_level` without its stopping rule and beam, for callers
+    that only own part of a level (see parallel_search). Children are numbered from
+    `id_offset` within their level.
+    """
+    next_paths = []
+    children = []
 
-    # Start with a single root path
-    root_path = ClinicalPath(initial_patient, "Path-0")
-    current_paths = [root_path]
+    # Score every path that still branches; batched mode does the whole level in one forward pass
+    frontier = [path for path in current_paths if not path.diagnosis_found]
+    if not frontier:
+        return current_paths, children
+    if frontier_predictions is None:
+        frontier_predictions = score_frontier(frontier, handle, suffix_ids, branching=branching, batched=batched)
+    frontier_predictions = iter(frontier_predictions)
 
-    # Perform 4 levels of branching (1 → 2 → 4 → 8 → 16)
-    for level in range(4):
-        next_paths = []
-        
+    with span('branch'):
         for path_idx, path in enumerate(current_paths):
             # Skip if diagnosis already found or sequence limit reached
             if path.diagnosis_found:
                 next_paths.append(path)  # Keep the path but don't branch
                 continue
-            
-            # Get top 2 predictions for branching
-            predictions = get_next_tokens(path.events, model, tokenizer, n_tokens=2)
-            
+
+            predictions = next(frontier_predictions)
+
             if len(predictions) == 0:
                 next_paths.append(path)  # Keep the path but don't branch
                 continue
-            elif len(predictions) == 1:
-                # Only one valid prediction, create one child
-                child_path = ClinicalPath(path.events, f"Path-{level+1}-{path_idx*2}", parent_id=path.path_id)
-                child_path.steps = copy.deepcopy(path.steps)  # Inherit parent's steps
-                child_path.add_event(predictions[0][0], predictions[0][1])
-                next_paths.append(child_path)
-                print(f"{path.path_id} → {child_path.path_id}: {predictions[0][0]} (prob: {predictions[0][1]:.4f})")
-            else:
-                # Create two children paths
-                for i, (token, prob) in enumerate(predictions[:2]):
-                    child_path = ClinicalPath(path.events, f"Path-{level+1}-{path_idx*2+i}", parent_id=path.path_id)
-                    child_path.steps = copy.deepcopy(path.steps)  # Inherit parent's steps
-                    child_path.add_event(token, prob)
+
+            for i, (token, prob, token_id) in enumerate(predictions):
+                # The child links to its parent and inherits its steps and model state
+                child_path = path.branch(f"Path-{level+1}-{id_offset + path_idx*branching + i}", token, prob, token_id)
+                if child_path.cumulative_probability >= min_cum_prob:
+                    children.append(child_path)
                     next_paths.append(child_path)
-        
+
+            # Children hold their own reference; this path is no longer expanded
+            path.past_key_values = None
+
+    return next_paths, children
+
+
+def expand_level(current_paths: List[ClinicalPath], level: int, handle: Optional[ModelHandle], suffix_ids: List[int],
+                 branching: int = 2, min_cum_prob: float = 0.0, max_frontier: Optional[int] = None,
+                 batched: bool = True, frontier_predictions: Optional[List[List[Tuple[str, float, int]]]] = None,
+                 id_offset: int = 0) -> List[ClinicalPath]:
+    """Grow the tree by one level.
+
+    Every open path gets up to `branching` children. Children whose cumulative probability
+    falls below `min_cum_prob` are pruned, and if more than `max_frontier` remain only the
+    most probable ones are kept. Paths with a diagnosis (or without a valid prediction) are
+    carried over unchanged. Returns `current_paths` itself when nothing new survived, which
+    ends the search. `frontier_predictions` can be passed in when the open paths were
+    already scored, e.g. together with other patients.
+    """
+    next_paths, children = grow_level(current_paths, level, handle, suffix_ids, branching=branching,
+                                      min_cum_prob=min_cum_prob, batched=batched,
+                                      frontier_predictions=frontier_predictions, id_offset=id_offset)
+
+    if not children and len(next_paths) < len(current_paths):
+        return current_paths
+
+    # Beam: keep only the most probable open children, in tree order
+    if max_frontier is not None and len(children) > max_frontier:
+        beam = sorted(children, key=lambda p: p.cumulative_probability, reverse=True)[:max_frontier]
+        dropped = set(map(id, children)) - set(map(id, beam))
+        next_paths = [path for path in next_paths if id(path) not in dropped]
+
+    return next_paths
+
+
+def run_branching_simulation(depth: int = 4, branching: int = 2, min_cum_prob: float = 0.0,
+                             max_frontier: Optional[int] = None, batched: bool = True,
+                             initial_patient: Optional[List[Event]] = None, model_id: str = MODEL_ID,
+                             on_level: Optional[Callable[[int, List[ClinicalPath]], None]] = None,
+                             handle: Optional[ModelHandle] = None):
+    """Build the pathway tree for the patient with a beam search over next events.
+
+    The defaults reproduce the full 1 → 2 → 4 → 8 → 16 tree; `min_cum_prob` and
+    `max_frontier` prune it so deeper searches stay bounded (see `expand_level`).
+    `on_level(level, paths)` is called with the leaves after every completed level.
+    The model is loaded once per process (see `model_registry.get_model`) unless a
+    `handle` is passed in.
+    """
+    if handle is None:
+        handle = get_model(model_id)
+    check_context(handle, depth)
+    # Initial patient history
+    if initial_patient is None:
+        initial_patient = patient2
+
+    # Start with a single root path; its history is run through the model once and
+    # every descendant extends the cached state instead of re-running it
+    root, suffix_ids = root_path(initial_patient, handle)
+    current_paths = [root]
+
+    for level in range(depth):
+        next_paths = expand_level(current_paths, level, handle, suffix_ids, branching=branching,
+                                  min_cum_prob=min_cum_prob, max_frontier=max_frontier, batched=batched)
+        if next_paths is current_paths:
+            break
         current_paths = next_paths
+        if on_level is not None:
+            on_level(level + 1, current_paths)
     return current_paths, initial_patient
-    
\ No newline at end of file
+
+
+def run_cohort_simulation(patients: Dict[str, List[Event]], depth: int = 4, branching: int = 2,
+                          min_cum_prob: float = 0.0, max_frontier: Optional[int] = None,
+                          model_id: str = MODEL_ID, handle: Optional[ModelHandle] = None,
+                          batch_size: Optional[int] = 64, workers: int = 1, store=None
+                          ) -> Dict[str, Tuple[List[ClinicalPath], List[Event]]]:
+    """Run the branching search for many patients at once.
+
+    Every level scores the open paths of all patients together, packed into shared
+    forward passes of up to `batch_size` rows; pruning and `max_frontier` apply per
+    patient. Returns {patient_id: (paths, initial_patient)} like `run_branching_simulation`.
+    With a `token_store.TokenStore`, the histories of `patients` are read from it
+    pre-tokenized (`patients` may then be `store.cohort(...)`).
+    """
+    if handle is None:
+        handle = get_model(model_id)
+    check_context(handle, depth)
+    if store is not None:
+        store.check(handle)
+
+    trees: Dict[str, List[ClinicalPath]] = {}
+    suffix_ids: List[int] = []
+    for patient_id, events in patients.items():
+        if store is not None:
+            root, suffix_ids = root_path(events, handle, store.history_ids(patient_id), store.suffix_ids)
+        else:
+            root, suffix_ids = root_path(events, handle)
+        trees[patient_id] = [root]
+
+    active = list(trees)
+    for level in range(depth):
+        frontiers = {patient_id: [path for path in trees[patient_id] if not path.diagnosis_found]
+                     for patient_id in active}
+        packed = [path for patient_id in active for path in frontiers[patient_id]]
+        if not packed:
+            break
+        predictions = iter(score_frontier(packed, handle, suffix_ids, branching=branching,
+                                          batch_size=batch_size, workers=workers))
+
+        still_active = []
+        for patient_id in active:
+            patient_predictions = [next(predictions) for _ in frontiers[patient_id]]
+            if not patient_predictions:
+                continue
+            next_paths = expand_level(trees[patient_id], level, handle, suffix_ids, branching=branching,
+                                      min_cum_prob=min_cum_prob, max_frontier=max_frontier,
+                                      frontier_predictions=patient_predictions)
+            if next_paths is not trees[patient_id]:
+                trees[patient_id] = next_paths
+                still_active.append(patient_id)
+        active = still_active
+
+    return {patient_id: (trees[patient_id], patients[patient_id]) for patient_id in trees}
+
+
+def _tree_nodes(paths: List[ClinicalPath]) -> List[ClinicalPath]:
+    """Every node of the tree behind `paths` once, parents before children"""
+    nodes = {}
+    for path in paths:
+        for node in path.lineage():
+            nodes.setdefault(id(node), node)
+    return list(nodes.values())
+
+
+def _free_index(nodes: List[ClinicalPath], level: int) -> int:
+    """First unused n for new "Path-{level}-{n}" ids"""
+    prefix = f"Path-{level}-"
+    used = [int(node.path_id[len(prefix):]) for node in nodes
+            if node.path_id.startswith(prefix) and node.path_id[len(prefix):].isdigit()]
+    return max(used) + 1 if used else 0
+
+
+def _restore_model_state(paths: List[ClinicalPath], handle: ModelHandle, history_ids: List[int], root_hash: str):
+    """Give the nodes of trees built without the model (e.g. loaded from the result cache)
+    their token ids and sequence hashes; paths without a cached prefix then rerun their
+    whole sequence once"""
+    for path in paths:
+        for node in path.lineage():
+            if node.parent is None:
+                node.set_token_ids(node.token_ids or history_ids)
+                if node.sequence_hash is None:
+                    node.sequence_hash = root_hash
+                continue
+            if not node.token_ids and node.step is not None:
+                node.set_token_ids([handle.vocab.text_to_id[node.step['token']]])
+            else:
+                node.set_token_ids(node.token_ids)  # Refresh its length if the root's changed
+            if node.sequence_hash is None and node.parent.sequence_hash is not None:
+                # Chained one token at a time, like `ClinicalPath.branch`
+                node.sequence_hash = extend_sequence_hash(node.parent.sequence_hash, node.token_ids)
+
+
+def deepen_tree(paths: List[ClinicalPath], initial_patient: List[Event], levels: int = 1,
+                node_id: Optional[str] = None, branching: int = 2, min_cum_prob: float = 0.0,
+                max_frontier: Optional[int] = None, model_id: str = MODEL_ID,
+                handle: Optional[ModelHandle] = None) -> List[ClinicalPath]:
+    """Grow an existing tree's leaves (only those under `node_id`, if given) by `levels` levels.
+
+    Untouched nodes are shared with the input tree. Leaves that still hold model state
+    only run their newest token; others (e.g. trees read back from the result cache)
+    rerun their sequence once. Deepening the whole tree by one level gives the same tree,
+    ids included, as a search one level deeper.
+    """
+    if handle is None:
+        handle = get_model(model_id)
+    history_ids, suffix_ids, root_hash = _history(initial_patient, handle)
+    selected = [path for path in paths
+                if node_id is None or any(node.path_id == node_id for node in path.lineage())]
+    if not selected:
+        raise ValueError(f"Unknown node {node_id}")
+    _restore_model_state(selected, handle, history_ids, root_hash)
+
+    # Leaves under one node are contiguous in tree order, so the grown block slots back in
+    start = next(idx for idx, path in enumerate(paths) if path is selected[0])
+    others = paths[:start] + paths[start + len(selected):]
+    current_paths = selected
+    level = max(len(path.steps) for path in selected)
+    check_context(handle, level + levels)
+    for _ in range(levels):
+        id_offset = _free_index(_tree_nodes(others + current_paths), level + 1)
+        next_paths = expand_level(current_paths, level, handle, suffix_ids, branching=branching,
+                                  min_cum_prob=min_cum_prob, max_frontier=max_frontier, id_offset=id_offset)
+        if next_paths is current_paths:
+            break
+        current_paths = next_paths
+        level += 1
+    return paths[:start] + current_paths + paths[start + len(selected):]
+
+
+def widen_tree(paths: List[ClinicalPath], initial_patient: List[Event], node_id: str, extra: int = 1,
+               model_id: str = MODEL_ID, handle: Optional[ModelHandle] = None) -> List[ClinicalPath]:
+    """Give node `node_id` up to `extra` more children: its next best events not already branched on"""
+    if handle is None:
+        handle = get_model(model_id)
+    nodes = _tree_nodes(paths)
+    node = next((node for node in nodes if node.path_id == node_id), None)
+    if node is None:
+        raise ValueError(f"Unknown node {node_id}")
+    if node.diagnosis_found:
+        raise ValueError(f"Node {node_id} ends in a diagnosis and isn't expanded")
+
+    history_ids, suffix_ids, root_hash = _history(initial_patient, handle)
+    _restore_model_state([node], handle, history_ids, root_hash)
+    children = [child for child in nodes if child.parent is node]
+    predictions = score_frontier([node], handle, suffix_ids, branching=len(children) + extra)[0]
+    existing = set(child.step['token'] for child in children)
+    level = len(node.steps) + 1
+    id_offset = _free_index(nodes, level)
+    new_children = [node.branch(f"Path-{level}-{id_offset + i}", token, prob, token_id)
+                    for i, (token, prob, token_id) in enumerate(
+                        [prediction for prediction in predictions if prediction[0] not in existing][:extra])]
+    node.past_key_values = None
+    if not new_children:
+        return paths
+
+    if any(path is node for path in paths):
+        idx = next(idx for idx, path in enumerate(paths) if path is node)
+        return paths[:idx] + new_children + paths[idx + 1:]
+    # Append after the node's last descendant leaf to keep tree order
+    idx = max(idx for idx, path in enumerate(paths) if any(ancestor is node for ancestor in path.lineage()))
+    return paths[:idx + 1] + new_children + paths[idx + 1:]
+
+
+def apply_extension(paths: List[ClinicalPath], initial_patient: List[Event], search: Dict, extension: Dict,
+                    model_id: str = MODEL_ID, handle: Optional[ModelHandle] = None) -> List[ClinicalPath]:
+    """Run one {"op": "deepen" | "widen", ...} step on the tree of `search`"""
+    op = extension.get('op')
+    if op == 'deepen':
+        return deepen_tree(paths, initial_patient, levels=int(extension.get('levels', 1)),
+                           node_id=extension.get('node_id'),
+                           branching=int(extension.get('branching', search['branching'])),
+                           min_cum_prob=search['min_cum_prob'], max_frontier=search['max_frontier'],
+                           model_id=model_id, handle=handle)
+    if op == 'widen':
+        if not extension.get('node_id'):
+            raise ValueError("widen needs a node_id")
+        return widen_tree(paths, initial_patient, extension['node_id'], extra=int(extension.get('extra', 1)),
+                          model_id=model_id, handle=handle)
+    raise ValueError(f"Unknown extension op {op!r}, expected 'deepen' or 'widen'")
@@ -0,0 +1,139 @@
+from hf_ehr.config import Event
+from typing import List, Optional
+from distribution_cache import extend_sequence_hash
+
+
+def omop_table_for(token_text: str) -> str:
+    """OMOP table of a predicted token, from its code system"""
+    system = token_text.split('/', 1)[0]
+    # Determine the table based on the system
+    if system == 'LOINC':
+        return 'measurement'
+    elif system == 'RxNorm':
+        return 'drug_exposure'
+    elif system == 'SNOMED':
+        # Could be condition or observation
+        return 'condition_occurrence' if 'condition' in token_text.lower() else 'observation'
+    elif system == 'CPT4':
+        return 'procedure_occurrence'
+    return 'observation'
+
+
+class ClinicalPath:
+    """Represents a single diagnostic pathway.
+
+    Paths form a tree: each node only stores the event it appended and links to its
+    parent, and the full event sequence is materialized on demand, so siblings share
+    their whole prefix instead of copying it.
+    """
+    __slots__ = ('path_id', 'parent', 'history', 'event', 'step', 'diagnosis_found', 'final_diagnosis',
+                 'cumulative_probability', 'past_key_values', 'token_ids', 'sequence_length', 'sequence_hash')
+
+    def __init__(self, events: List[Event], path_id: str, parent: Optional['ClinicalPath'] = None):
+        self.path_id = path_id
+        self.parent = parent
+        self.history = list(events) if parent is None else None  # Initial patient, root only
+        self.event = None  # Event appended by this node
+        self.step = None  # Step record for that event
+        self.diagnosis_found = False
+        self.final_diagnosis = None
+        self.cumulative_probability = parent.cumulative_probability if parent is not None else 1.0
+        # Token ids this node adds (the root: the tokenized history) and the length of the
+        # whole path's sequence
+        self.token_ids: List[int] = []
+        self.sequence_length = parent.sequence_length if parent is not None else 0
+        # Model state: `past_key_values` covers a prefix of the sequence (the path's own, or
+        # its nearest scored ancestor's); the tokens past it still have to be run
+        self.past_key_values = parent.past_key_values if parent is not None else None
+        # Hash of the path's token ids (see distribution_cache), when they are known
+        self.sequence_hash: Optional[str] = None
+
+    @property
+    def parent_id(self) -> Optional[str]:
+        return self.parent.path_id if self.parent is not None else None
+
+    def lineage(self) -> List['ClinicalPath']:
+        """Nodes from the root down to this one"""
+        nodes = []
+        node = self
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        nodes.reverse()
+        return nodes
+
+    @property
+    def events(self) -> List[Event]:
+        """Initial patient events followed by every predicted event on this path"""
+        nodes = self.lineage()
+        return nodes[0].history + [node.event for node in nodes[1:] if node.event is not None]
+
+    def set_token_ids(self, token_ids: List[int]):
+        """Set the ids this node adds to its parent's sequence"""
+        self.token_ids = list(token_ids)
+        self.sequence_length = (self.parent.sequence_length if self.parent is not None else 0) + len(self.token_ids)
+
+    def tail_ids(self, count: int) -> List[int]:
+        """The last `count` token ids of the path's sequence, gathered up the tree"""
+        ids: List[int] = []
+        node = self
+        while node is not None and len(ids) < count:
+            ids[:0] = node.token_ids
+            node = node.parent
+        return ids[len(ids) - count:] if count > 0 else []
+
+    @property
+    def steps(self) -> List[dict]:
+        """The journey from the initial patient state"""
+        return [node.step for node in self.lineage() if node.step is not None]
+
+    def branch(self, path_id: str, token_text: str, probability: float, token_id: Optional[int] = None) -> 'ClinicalPath':
+        """Create a child path that appends one predicted event to this one"""
+        child = ClinicalPath([], path_id, parent=self)
+        child.add_event(token_text, probability, token_id)
+        if self.sequence_hash is not None and token_id is not None:
+            child.sequence_hash = extend_sequence_hash(self.sequence_hash, [token_id])
+        return child
+
+    def add_event(self, token_text: str, probability: float, token_id: Optional[int] = None):
+        """Set the event this node adds to its parent's path"""
+        # Parse the token to create an Event
+        if '/' in token_text:
+            omop_table = omop_table_for(token_text)
+
+            self.event = Event(
+                code=token_text,
+                value=f"Predicted: {token_text}",
+                unit=None,
+                start='2025-08-23T14:00:00.000Z',
+                end=None,
+                omop_table=omop_table
+            )
+            self.step = {
+                'token': token_text,
+                'probability': probability,
+                'type': omop_table,
+                'node_id': self.path_id  # Tree node that introduced this step
+            }
+            self.cumulative_probability *= probability
+            if token_id is not None:
+                self.set_token_ids([token_id])
+
+            # Check if this is a diagnosis (condition_occurrence)
+            if omop_table == 'condition_occurrence':
+                self.diagnosis_found = True
+                self.final_diagnosis = token_text
+
+
+def release_model_state(paths: List[ClinicalPath]):
+    """Drop the KV caches held anywhere in the tree behind `paths`.
+
+    Trees that are kept around, e.g. in the app's caches, would otherwise hold one
+    full-history cache per expanded leaf; extending them later restores the state once.
+    """
+    seen = set()
+    for path in paths:
+        for node in path.lineage():
+            if id(node) not in seen:
+                seen.add(id(node))
+                node.past_key_values = None
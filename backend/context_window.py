@@ -0,0 +1,142 @@
+"""Fit long patient histories into the model's context.
+
+Real records carry years of events, far more than the model's position embeddings. Each
+loaded model gets a `ContextWindow` that cuts the history before tokenization, leaving
+`reserve` positions for the predicted events a search appends, so every forward pass
+stays bounded. Strategies:
+
+- `recent`: the most recent events, up to the token budget
+- `conditions`: every diagnosis (condition_occurrence) plus the most recent other events
+- `time`: events within `days` of the latest one, then `recent` if still too long
+
+Set with CLMBR_CONTEXT_STRATEGY, CLMBR_CONTEXT_MAX_TOKENS (default: the model's maximum),
+CLMBR_CONTEXT_RESERVE and CLMBR_CONTEXT_DAYS.
+"""
+from hf_ehr.config import Event
+from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+from profiling import metrics
+import os
+
+STRATEGIES = ('recent', 'conditions', 'time')
+CONTEXT_STRATEGY = os.environ.get("CLMBR_CONTEXT_STRATEGY", "recent")
+CONTEXT_MAX_TOKENS = int(os.environ["CLMBR_CONTEXT_MAX_TOKENS"]) if os.environ.get("CLMBR_CONTEXT_MAX_TOKENS") else None
+# Positions left for predicted events and the trailing special tokens, i.e. the deepest search
+CONTEXT_RESERVE = int(os.environ.get("CLMBR_CONTEXT_RESERVE", 64))
+CONTEXT_DAYS = float(os.environ.get("CLMBR_CONTEXT_DAYS", 365))
+
+metrics.describe('climbr_context_truncations_total', "Patient histories cut to fit the model context")
+metrics.describe('climbr_context_events_dropped_total', "Events left out of truncated histories")
+
+
+def context_key() -> Optional[Dict]:
+    """The configured settings for result cache keys, or None for the defaults (keys predate them)"""
+    if CONTEXT_STRATEGY == 'recent' and CONTEXT_MAX_TOKENS is None and CONTEXT_RESERVE == 64:
+        return None
+    return {'strategy': CONTEXT_STRATEGY, 'max_tokens': CONTEXT_MAX_TOKENS, 'reserve': CONTEXT_RESERVE,
+            'days': CONTEXT_DAYS if CONTEXT_STRATEGY == 'time' else None}
+
+
+def _event_time(event: Event) -> Optional[datetime]:
+    start = event.start
+    if isinstance(start, str):
+        try:
+            start = datetime.fromisoformat(start.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if isinstance(start, datetime) and start.tzinfo is not None:
+        start = start.replace(tzinfo=None)
+    return start if isinstance(start, datetime) else None
+
+
+class ContextWindow:
+    """How histories are cut for one model: at most `max_tokens - reserve` history tokens"""
+    def __init__(self, max_tokens: int, strategy: str = CONTEXT_STRATEGY, reserve: int = CONTEXT_RESERVE,
+                 days: float = CONTEXT_DAYS):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown context strategy {strategy!r}, expected one of {', '.join(STRATEGIES)}")
+        self.max_tokens = max_tokens
+        self.strategy = strategy
+        self.reserve = reserve
+        self.days = days
+
+    @classmethod
+    def for_model(cls, config) -> Optional['ContextWindow']:
+        """The configured window for a model config, or None when its context is unknown"""
+        max_tokens = CONTEXT_MAX_TOKENS or getattr(config, 'max_position_embeddings', None)
+        return cls(max_tokens) if max_tokens else None
+
+    @property
+    def budget(self) -> int:
+        return max(1, self.max_tokens - self.reserve)
+
+    @staticmethod
+    def _has_token(event: Event, tokenizer) -> bool:
+        # CLMBR turns an event into at most one token; unknown codes into none
+        if hasattr(tokenizer, 'convert_event_to_token'):
+            return tokenizer.convert_event_to_token(event) is not None
+        return True
+
+    def count_tokens(self, events: List[Event], tokenizer) -> int:
+        """Event tokens `events` tokenize to, not counting special tokens"""
+        return sum(1 for event in events if self._has_token(event, tokenizer))
+
+    def _most_recent(self, events: List[Event], tokenizer, budget: int) -> List[int]:
+        """Indices of the most recent events that produce `budget` tokens at most"""
+        kept = []
+        for idx in range(len(events) - 1, -1, -1):
+            if self._has_token(events[idx], tokenizer):
+                if budget <= 0:
+                    break
+                budget -= 1
+            kept.append(idx)
+        return kept
+
+    def select(self, events: List[Event], tokenizer, budget: Optional[int] = None) -> List[Event]:
+        """The events of `events` (in their order) the strategy keeps within `budget` event tokens.
+
+        Histories that already fit are returned as they are, whatever the strategy.
+        """
+        budget = self.budget if budget is None else budget
+        if self.count_tokens(events, tokenizer) <= budget:
+            return events
+        if self.strategy == 'time':
+            times = [_event_time(event) for event in events]
+            known = [time for time in times if time is not None]
+            if known:
+                cutoff = max(known) - timedelta(days=self.days)
+                # Events without a usable time can't be placed, so they stay
+                events = [event for event, time in zip(events, times) if time is None or time >= cutoff]
+            kept = self._most_recent(events, tokenizer, budget)
+        elif self.strategy == 'conditions':
+            conditions = [idx for idx, event in enumerate(events)
+                          if event.omop_table == 'condition_occurrence' and self._has_token(event, tokenizer)]
+            kept = conditions[-budget:]
+            condition_set = set(conditions)
+            others = [idx for idx in range(len(events)) if idx not in condition_set]
+            kept += [others[idx] for idx in self._most_recent([events[idx] for idx in others], tokenizer,
+                                                              budget - len(kept))]
+        else:
+            kept = self._most_recent(events, tokenizer, budget)
+        return [events[idx] for idx in sorted(kept)]
+
+    def cap(self, history_ids: List[int], tokenizer) -> List[int]:
+        """Hard limit on the tokenized history, keeping its leading special tokens"""
+        if len(history_ids) <= self.budget:
+            return history_ids
+        special = set(getattr(tokenizer, 'all_special_ids', []))
+        prefix = 0
+        while prefix < len(history_ids) and history_ids[prefix] in special:
+            prefix += 1
+        prefix = min(prefix, self.budget - 1)
+        return history_ids[:prefix] + history_ids[len(history_ids) - (self.budget - prefix):]
+
+    def record(self, report: Dict):
+        """Count (and log) a history that had to be cut"""
+        if not report['truncated']:
+            return
+        metrics.inc('climbr_context_truncations_total', {'strategy': self.strategy})
+        metrics.inc('climbr_context_events_dropped_total', {'strategy': self.strategy},
+                    report['events_total'] - report['events_kept'])
+        print(f"History truncated ({self.strategy}): kept {report['events_kept']}/{report['events_total']} events, "
+              f"{report['tokens_kept']} tokens")
@@ -0,0 +1,127 @@
+"""Memo of next-event predictions keyed by the token-id sequence they were computed for.
+
+Branches of one tree, repeated searches and different requests for the same patient keep
+reaching sequences that were already scored. Every path carries a hash of its token ids
+(`ClinicalPath.sequence_hash`, extended by one token per branch), and the filtered top-k
+predictions for that sequence are kept here, so a repeated node costs a dictionary lookup
+instead of a forward pass. The memo is LRU-bounded and counts hits and misses; with
+CLMBR_DISTRIBUTION_CACHE_FILE set it is loaded at startup and written back at exit.
+"""
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from array import array
+from pathlib import Path
+from profiling import metrics
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Entries kept in memory; 0 disables the memo
+DISTRIBUTION_CACHE_SIZE = int(os.environ.get("CLMBR_DISTRIBUTION_CACHE_SIZE", 100_000))
+DISTRIBUTION_CACHE_FILE = os.environ.get("CLMBR_DISTRIBUTION_CACHE_FILE")
+
+Predictions = List[Tuple[str, float, int]]
+
+metrics.describe('climbr_distribution_cache_total', "Next-event prediction memo lookups by result")
+
+
+def extend_sequence_hash(prefix: Optional[str], token_ids: List[int]) -> str:
+    """Hash of a token-id sequence, built from the hash of its prefix and the ids appended to it"""
+    digest = hashlib.blake2b(digest_size=16)
+    if prefix is not None:
+        digest.update(bytes.fromhex(prefix))
+    digest.update(array('q', token_ids).tobytes())
+    return digest.hexdigest()
+
+
+def history_hash(history_ids: List[int], patient_codes: Optional[List[str]] = None) -> str:
+    """Sequence hash of a tree's root.
+
+    The cached predictions are filtered against every code the patient has, including
+    those of events the context window cut from `history_ids`. When it cut any, pass the
+    patient's codes: the hash then covers them too, so such histories never share entries.
+    """
+    prefix = None
+    if patient_codes is not None:
+        codes = '\n'.join(sorted(set(patient_codes))).encode('utf-8')
+        prefix = hashlib.blake2b(codes, digest_size=16).hexdigest()
+    return extend_sequence_hash(prefix, history_ids)
+
+
+class DistributionCache:
+    """LRU map from a sequence key to its top-k predictions, most probable first.
+
+    An entry computed for k candidates also answers requests for fewer.
+    """
+    def __init__(self, max_entries: int = DISTRIBUTION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[str, Tuple[int, Predictions]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str, k: int) -> Optional[Predictions]:
+        with self.lock:
+            entry = self.entries.get(key)
+            # Fewer predictions than asked for means the allowed candidates ran out
+            if entry is not None and (entry[0] >= k or len(entry[1]) < entry[0]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc('climbr_distribution_cache_total', {'result': 'hit'})
+                return entry[1][:k]
+            self.misses += 1
+        metrics.inc('climbr_distribution_cache_total', {'result': 'miss'})
+        return None
+
+    def put(self, key: str, k: int, predictions: Predictions):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < k:
+                self.entries[key] = (k, list(predictions))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def save(self, path: str):
+        """Write the entries, least recently used first, as gzipped JSON"""
+        with self.lock:
+            data = [[key, k, predictions] for key, (k, predictions) in self.entries.items()]
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(gzip.compress(json.dumps(data).encode('utf-8'), compresslevel=1))
+        os.replace(tmp_name, path)  # Atomic, so concurrent readers never see a partial file
+
+    def load(self, path: str):
+        """Add the entries saved at `path`, if any"""
+        try:
+            data = json.loads(gzip.decompress(Path(path).read_bytes()))
+        except (OSError, ValueError) as e:
+            print(f"Distribution cache {path} not loaded: {e}")
+            return
+        for key, k, predictions in data:
+            self.put(key, k, [tuple(prediction) for prediction in predictions])
+
+
+distribution_cache = DistributionCache()
+if DISTRIBUTION_CACHE_FILE and DISTRIBUTION_CACHE_SIZE > 0:
+    if os.path.exists(DISTRIBUTION_CACHE_FILE):
+        distribution_cache.load(DISTRIBUTION_CACHE_FILE)
+    atexit.register(distribution_cache.save, DISTRIBUTION_CACHE_FILE)
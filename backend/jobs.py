@@ -0,0 +1,151 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import os
+import threading
+import uuid
+
+JOB_WORKERS = int(os.environ.get("SIMULATION_JOB_WORKERS", 1))
+MAX_FINISHED_JOBS = 1000
+
+
+class SimulationJob:
+    """A simulation running in the background, with the payload of every completed level"""
+    def __init__(self, key: str):
+        self.job_id = uuid.uuid4().hex
+        self.key = key
+        self.status = 'queued'  # queued -> running -> done | error
+        self.levels: List[dict] = []
+        self.error: Optional[str] = None
+        self.condition = threading.Condition()
+
+    def report_level(self, payload: dict):
+        with self.condition:
+            self.levels.append(payload)
+            self.condition.notify_all()
+
+    def set_status(self, status: str, error: Optional[str] = None):
+        with self.condition:
+            self.status = status
+            self.error = error
+            self.condition.notify_all()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'error')
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'levels_completed': len(self.levels),
+            'error': self.error,
+        }
+
+    def stream(self, timeout: float = 15.0):
+        """Yield ('level', payload) for each completed level, then ('done' | 'error', status dict).
+
+        Yields ('ping', None) whenever nothing happened for `timeout` seconds so callers can
+        keep idle connections alive.
+        """
+        sent = 0
+        while True:
+            with self.condition:
+                if sent == len(self.levels) and not self.finished:
+                    self.condition.wait(timeout)
+                levels = self.levels[sent:]
+                finished = self.finished
+            if not levels and not finished:
+                yield 'ping', None
+            for payload in levels:
+                yield 'level', payload
+            sent += len(levels)
+            if finished and sent == len(self.levels):
+                yield self.status, self.to_dict()
+                return
+
+
+class JobManager:
+    """Runs simulations on a background executor; one job per simulation key at a time"""
+    def __init__(self, max_workers: int = JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='simulation')
+        self.jobs: Dict[str, SimulationJob] = {}
+        self.active: Dict[str, SimulationJob] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key: str, run: Callable[[Callable[[dict], None]], None]) -> SimulationJob:
+        """Start `run(report_level)` unless a job for `key` is already queued or running"""
+        with self.lock:
+            job = self.active.get(key)
+            if job is not None:
+                return job
+            job = SimulationJob(key)
+            # Forget the oldest finished jobs so polling state doesn't grow forever
+            finished = [job_id for job_id, old in self.jobs.items() if old.finished]
+            for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[job_id]
+            self.jobs[job.job_id] = job
+            self.active[key] = job
+        self.executor.submit(self._run, job, run)
+        return job
+
+    def _run(self, job: SimulationJob, run: Callable[[Callable[[dict], None]], None]):
+        job.set_status('running')
+        try:
+            run(job.report_level)
+            job.set_status('done')
+        except Exception as e:
+            job.set_status('error', str(e))
+        finally:
+            with self.lock:
+                self.active.pop(job.key, None)
+
+    def get(self, job_id: str) -> Optional[SimulationJob]:
+        return self.jobs.get(job_id)
+
+
+class SingleFlight:
+    """Runs `fn` once per key at a time: concurrent callers for a key that is already being
+    computed wait for that computation and share its result (or exception)"""
+    def __init__(self):
+        self.calls: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Return (result, shared); `shared` is True when another caller's run produced it"""
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result(), True
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future.result(), False
+
+
+class KeyedLock:
+    """One lock per key, held only while someone uses it, so the keys can be client-controlled"""
+    def __init__(self):
+        self.locks: Dict[str, List] = {}  # key -> [lock, callers holding or waiting for it]
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key: str):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
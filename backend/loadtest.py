@@ -0,0 +1,244 @@
+"""Load-test the API with concurrent request mixes.
+
+    python loadtest.py                              # every scenario, against a stand-in model
+    python loadtest.py cold-burst cold-mix --concurrency 32 --output load.json
+    python loadtest.py warm-mix --url http://localhost:5000
+
+By default the app is started in this process on a threaded HTTP server, with the
+deterministic stand-in model of `benchmark.build_stand_in_model` and a throwaway result
+cache, so the numbers measure the serving path rather than the real model. Cold scenarios
+clear every cache first. Each scenario reports throughput, latency percentiles, the
+simulation counts from /metrics and how many simulations ran more than once for the
+same key (`duplicate_simulations`, which single-flight keeps at 0).
+
+With --url the scenarios run against a server that is already up; its caches can't be
+reset from here, so "cold" only means whatever state that server is in.
+"""
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from benchmark import build_stand_in_model, peak_rss_mb
+
+SEARCHES = ['depth=2&branching=2', 'depth=3&branching=2', 'depth=4&branching=2', 'depth=3&branching=3']
+
+# Every request of a scenario picks the next (endpoint, query) pair; pathways and
+# predictions for the same query share one simulation
+SCENARIOS = {
+    'cold-burst': {
+        'description': "Every client asks for the same uncached tree at once",
+        'endpoints': ['/api/pathways'], 'queries': SEARCHES[2:3], 'cold': True,
+        'concurrency': 16, 'requests': 16,
+    },
+    'cold-mix': {
+        'description': "Pathways and predictions for several uncached searches",
+        'endpoints': ['/api/pathways', '/api/predictions'], 'queries': SEARCHES, 'cold': True,
+        'concurrency': 16, 'requests': 200,
+    },
+    'warm-mix': {
+        'description': "The same mix once every search is cached",
+        'endpoints': ['/api/pathways', '/api/predictions'], 'queries': SEARCHES, 'cold': False,
+        'concurrency': 16, 'requests': 1000,
+    },
+    'warm-gzip': {
+        'description': "Cached tree-format pathways to gzip-accepting clients",
+        'endpoints': ['/api/pathways'], 'queries': [f"{query}&format=tree" for query in SEARCHES], 'cold': False,
+        'concurrency': 16, 'requests': 1000, 'gzip': True,
+    },
+    'sample-burst': {
+        'description': "Concurrent uncached Monte Carlo predictions for one setting",
+        'endpoints': ['/api/predictions'], 'queries': ['mode=sample&samples=64&max_length=4'], 'cold': True,
+        'concurrency': 16, 'requests': 32,
+    },
+}
+
+METRIC_LINE = re.compile(r'^climbr_simulations_total\{source="(\w+)"\} (\S+)$')
+
+
+def _percentiles(samples: List[float]) -> Dict:
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def at(fraction):
+        return 1000 * samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    return {
+        'mean_ms': 1000 * sum(samples) / len(samples),
+        'p50_ms': at(0.50),
+        'p90_ms': at(0.90),
+        'p99_ms': at(0.99),
+        'max_ms': 1000 * samples[-1],
+    }
+
+
+def simulation_counts(base_url: str) -> Dict[str, float]:
+    """climbr_simulations_total by source, read from the server's /metrics"""
+    with urllib.request.urlopen(f"{base_url}/metrics") as response:
+        text = response.read().decode('utf-8')
+    counts = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            counts[match.group(1)] = float(match.group(2))
+    return counts
+
+
+def _fetch(url: str, gzip_ok: bool):
+    """(status, seconds, bytes) for one GET"""
+    headers = {'Accept-Encoding': 'gzip'} if gzip_ok else {}
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            size = len(response.read())
+            status = response.status
+    except urllib.error.HTTPError as e:
+        size = len(e.read())
+        status = e.code
+    except OSError:
+        status, size = 0, 0  # Connection failed
+    return status, time.perf_counter() - start, size
+
+
+def run_scenario(base_url: str, scenario: Dict, concurrency: Optional[int] = None,
+                 requests: Optional[int] = None) -> Dict:
+    """Fire the scenario's requests from `concurrency` threads; returns its report"""
+    concurrency = concurrency or scenario['concurrency']
+    requests = requests or scenario['requests']
+    urls = [f"{base_url}{endpoint}?{query}" for query in scenario['queries'] for endpoint in scenario['endpoints']]
+    before = simulation_counts(base_url)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: _fetch(urls[i % len(urls)], scenario.get('gzip', False)),
+                                range(requests)))
+    wall = time.perf_counter() - start
+
+    after = simulation_counts(base_url)
+    simulations = {source: after.get(source, 0) - before.get(source, 0)
+                   for source in sorted(set(before) | set(after))}
+    statuses: Dict[str, int] = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [seconds for status, seconds, _ in results if status == 200]
+    # A cold scenario needs one model run per distinct query; anything beyond that is a duplicate
+    expected = min(len(scenario['queries']), requests) if scenario['cold'] else 0
+    return {
+        'description': scenario['description'],
+        'concurrency': concurrency,
+        'requests': requests,
+        'distinct_simulations': len(scenario['queries']),
+        'statuses': statuses,
+        'errors': requests - len(ok),
+        'wall_s': wall,
+        'throughput_rps': requests / wall if wall > 0 else None,
+        'latency': _percentiles(ok),
+        'response_bytes': sum(size for status, _, size in results if status == 200),
+        'simulations': simulations,
+        'duplicate_simulations': max(0, int(simulations.get('model', 0)) - expected),
+    }
+
+
+class LocalServer:
+    """The app on a threaded HTTP server in this process, backed by a stand-in model"""
+    def __init__(self, workdir: str, n_codes: int, n_layer: int, n_embd: int):
+        model_dir = os.path.join(workdir, 'model')
+        build_stand_in_model(model_dir, n_codes=n_codes, n_layer=n_layer, n_embd=n_embd)
+        # The app reads these at import
+        os.environ['CLMBR_MODEL_ID'] = model_dir
+        os.environ['PATHWAY_CACHE_DIR'] = os.path.join(workdir, 'cache')
+        os.environ.pop('MODEL_SERVER', None)
+        import logging
+        from werkzeug.serving import make_server
+        import app as app_module
+        from model_registry import get_model
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # No line per request
+        get_model(model_dir)  # Load outside the measured requests
+        self.app_module = app_module
+        self.server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        """Forget every cached simulation, response and next-event distribution"""
+        from distribution_cache import distribution_cache
+        for path in self.app_module.result_cache.directory.glob('*.json.gz'):
+            path.unlink()
+        self.app_module.cached_runs.clear()
+        self.app_module.cached_responses.clear()
+        distribution_cache.clear()
+
+    def warm(self, scenario: Dict):
+        for query in scenario['queries']:
+            for endpoint in scenario['endpoints']:
+                _fetch(f"{self.base_url}{endpoint}?{query}", scenario.get('gzip', False))
+
+    def close(self):
+        self.server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test /api/pathways and /api/predictions")
+    parser.add_argument('scenarios', nargs='*', help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--concurrency', type=int, default=None, help="Client threads (default: per scenario)")
+    parser.add_argument('--requests', type=int, default=None, help="Requests per scenario (default: per scenario)")
+    parser.add_argument('--url', help="Test this running server instead of a local one")
+    parser.add_argument('--layers', type=int, default=2, help="Stand-in model layers")
+    parser.add_argument('--embd', type=int, default=64, help="Stand-in model width")
+    parser.add_argument('--codes', type=int, default=2000, help="Synthetic vocabulary size")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    workdir = None
+    local = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        workdir = tempfile.mkdtemp(prefix='climbr-load-')
+        local = LocalServer(workdir, args.codes, args.layers, args.embd)
+        base_url = local.base_url
+
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'url': args.url, 'config': vars(args),
+              'scenarios': {}}
+    try:
+        for name in args.scenarios or list(SCENARIOS):
+            scenario = SCENARIOS[name]
+            if local is not None:
+                local.reset()
+                if not scenario['cold']:
+                    local.warm(scenario)
+            result = run_scenario(base_url, scenario, args.concurrency, args.requests)
+            report['scenarios'][name] = result
+            print(f"{name}: {result['throughput_rps']:.1f} req/s, p50 {result['latency'].get('p50_ms', 0):.1f} ms, "
+                  f"p99 {result['latency'].get('p99_ms', 0):.1f} ms, {result['errors']} errors, "
+                  f"{result['duplicate_simulations']} duplicate simulations", file=sys.stderr)
+    finally:
+        if local is not None:
+            local.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+    if local is not None:
+        report['peak_rss_mb'] = peak_rss_mb()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
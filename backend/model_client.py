@@ -0,0 +1,86 @@
+"""Client for `model_server`, so the API can run simulations without loading torch.
+
+Set MODEL_SERVER to the server's address ("host:port", or the path of a Unix socket) and
+MODEL_SERVER_AUTHKEY to its key. The key is required on both sides: connections exchange
+pickles, so anyone holding it can run code on the server. Each thread keeps one connection
+open and reconnects once when the server has gone away.
+"""
+from hf_ehr.config import Event
+from typing import Dict, List, Optional, Tuple, Union
+from multiprocessing.connection import Client
+from result_cache import deserialize_paths, serialize_paths
+import os
+import threading
+
+MODEL_SERVER = os.environ.get("MODEL_SERVER")
+MODEL_SERVER_AUTHKEY = os.environ.get("MODEL_SERVER_AUTHKEY", "").encode('utf-8') or None
+
+
+def require_authkey(authkey: Optional[bytes]) -> bytes:
+    if not authkey:
+        raise ValueError("MODEL_SERVER_AUTHKEY must be set: model server connections exchange pickles, "
+                         "so the key is all that keeps others from running code on the server")
+    return authkey
+
+
+def parse_address(address: str) -> Union[Tuple[str, int], str]:
+    """("host", port) for "host:port", else the Unix socket path itself"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host or 'localhost', int(port)
+    return address
+
+
+class ModelClient:
+    """Runs model work on a `model_server`; results have the same form as the local functions"""
+    def __init__(self, address: str = MODEL_SERVER, authkey: Optional[bytes] = MODEL_SERVER_AUTHKEY):
+        self.address = parse_address(address)
+        self.authkey = require_authkey(authkey)
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = Client(self.address, authkey=self.authkey)
+        return self._local.connection
+
+    def _call(self, op: str, **payload):
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                connection.send({'op': op, **payload})
+                reply = connection.recv()
+                break
+            except (EOFError, OSError):
+                self._local.connection = None
+                if attempt:
+                    raise
+        if 'error' in reply:
+            raise RuntimeError(f"Model server: {reply['error']}")
+        return reply['result']
+
+    def simulate_cohort(self, patients: Dict[str, List[Event]], search: Dict
+                        ) -> Dict[str, Tuple[list, List[Event]]]:
+        """`run_cohort_simulation` on the server"""
+        results = self._call('simulate', patients=patients, search=search)
+        return {patient_id: deserialize_paths(results[patient_id]) for patient_id in patients}
+
+    def simulate(self, initial_patient: List[Event], search: Dict) -> Tuple[list, List[Event]]:
+        """`run_branching_simulation` on the server"""
+        return self.simulate_cohort({'patient': initial_patient}, search)['patient']
+
+    def predict(self, patients: List[List[Event]], n_tokens: int = 2) -> List[List[Tuple[str, float, int]]]:
+        """Top `n_tokens` next events for each history, as `score_frontier` picks them for a root"""
+        return self._call('predict', patients=patients, n_tokens=n_tokens)
+
+    def sample(self, initial_patient: List[Event], params: Dict) -> Tuple[List[Dict], List[Event]]:
+        """`sampling.run_monte_carlo_simulation` on the server"""
+        return self._call('sample', initial_patient=initial_patient, params=params), initial_patient
+
+    def extend(self, paths: list, initial_patient: List[Event], search: Dict, extension: Dict) -> list:
+        """`climbr_branching.apply_extension` on the server"""
+        tree = self._call('extend', tree=serialize_paths(paths, initial_patient), search=search,
+                          extension=extension)
+        return deserialize_paths(tree)[0]
+
+    def stats(self) -> Dict:
+        return self._call('stats')
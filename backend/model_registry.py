@@ -0,0 +1,183 @@
+from transformers import AutoModelForCausalLM
+from hf_ehr.data.tokenization import CLMBRTokenizer
+from hf_ehr.config import Event
+from typing import List, Dict, Optional, Tuple
+import torch
+import bisect
+import os
+import threading
+import time
+from profiling import span
+from context_window import ContextWindow
+from settings import MODEL_ID, MODEL_PRECISION
+
+TORCH_NUM_THREADS = os.environ.get("TORCH_NUM_THREADS")
+# Opt-in inference optimizations next to settings.MODEL_PRECISION
+MODEL_COMPILE = bool(os.environ.get("CLMBR_COMPILE"))
+INFERENCE_MODE = bool(os.environ.get("CLMBR_INFERENCE_MODE"))
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16, 'int8': torch.float32}
+
+# Only these systems are offered as next events; Domain/, Visit/ and special tokens never are
+CODE_PREFIXES = ('LOINC/', 'SNOMED/', 'RxNorm/', 'CPT4/')
+SKIPPED_TOKENS = ['<pad>', '<unk>', '<s>', '</s>']
+
+
+class VocabularyFilter:
+    """Vocabulary-wide lookup tables for next-token filtering, built once per loaded model.
+
+    `id_to_text` caches the decoded text of every token id and `allowed` marks the ids that
+    are valid medical codes, so candidate filtering is a tensor mask instead of a decode per
+    candidate.
+    """
+    def __init__(self, tokenizer, vocab_size: int):
+        self.id_to_text: List[str] = []
+        for token_id in range(vocab_size):
+            try:
+                if hasattr(tokenizer, 'decode'):
+                    token_text = tokenizer.decode([token_id])
+                else:
+                    token_text = tokenizer.convert_ids_to_tokens([token_id])[0]
+            except Exception:
+                token_text = ''
+            self.id_to_text.append(token_text or '')
+
+        self.allowed = torch.tensor([self._is_allowed(text) for text in self.id_to_text], dtype=torch.bool)
+        self.text_to_id: Dict[str, int] = {}
+        for token_id, text in enumerate(self.id_to_text):
+            self.text_to_id.setdefault(text, token_id)
+        # Sorted (text, id) pairs so every token starting with a code is a contiguous range
+        self._sorted_texts = sorted((text, token_id) for token_id, text in enumerate(self.id_to_text))
+        self._sorted_keys = [text for text, _ in self._sorted_texts]
+        self._code_ids: Dict[str, torch.Tensor] = {}
+
+    @staticmethod
+    def _is_allowed(token_text: str) -> bool:
+        # Skip special tokens and domain markers
+        if (token_text.startswith("Domain/") or
+            token_text.startswith("Visit/") or
+            token_text in SKIPPED_TOKENS):
+            return False
+        # Only include medical codes with proper format
+        return token_text.startswith(CODE_PREFIXES)
+
+    def ids_for_code(self, code: str) -> torch.Tensor:
+        """Ids of every token whose text starts with `code` (e.g. all value ranges of a LOINC code)"""
+        if code not in self._code_ids:
+            start = bisect.bisect_left(self._sorted_keys, code)
+            end = start
+            while end < len(self._sorted_keys) and self._sorted_keys[end].startswith(code):
+                end += 1
+            self._code_ids[code] = torch.tensor([token_id for _, token_id in self._sorted_texts[start:end]], dtype=torch.long)
+        return self._code_ids[code]
+
+    def candidate_mask(self, patient_events: List[Event]) -> torch.Tensor:
+        """Allowed ids minus every code already present in the patient events"""
+        mask = self.allowed.clone()
+        for code in set(event.code for event in patient_events):
+            mask[self.ids_for_code(code)] = False
+        return mask
+
+
+
+class ModelHandle:
+    """A loaded model/tokenizer pair plus the lookup tables built from it, shared by every simulation"""
+    def __init__(self, model_id: str, model, tokenizer, vocab: VocabularyFilter, precision: str = 'fp32',
+                 inference_mode: bool = INFERENCE_MODE, context: Optional[ContextWindow] = None):
+        self.model_id = model_id
+        self.model = model
+        self.tokenizer = tokenizer
+        self.vocab = vocab
+        self.precision = precision
+        self.inference_mode = inference_mode
+        self.context = context  # How long histories are cut to fit the model
+
+
+def inference_context(inference_mode: bool = False):
+    """`torch.inference_mode()` when enabled, else the plain `torch.no_grad()`"""
+    return torch.inference_mode() if inference_mode else torch.no_grad()
+
+
+_handles: Dict[Tuple[str, str, bool], ModelHandle] = {}
+_handles_lock = threading.Lock()
+
+
+def load_tokenizer(model_id: str):
+    """CLMBRTokenizer from the hub, or from a local checkpoint directory when `model_id` is a path"""
+    if os.path.isdir(model_id):
+        return CLMBRTokenizer(os.path.join(model_id, "tokenizer_config.json"))
+    return CLMBRTokenizer.from_pretrained(model_id)
+
+
+def warm_up(handle: ModelHandle):
+    """Run one tiny forward pass so the first real request doesn't pay for lazy initialization"""
+    tokenizer = handle.tokenizer
+    input_ids = torch.tensor([[tokenizer.bos_token_id, tokenizer.eos_token_id]])
+    with inference_context(handle.inference_mode):
+        handle.model(input_ids=input_ids)
+
+
+def _conv1d_to_linear(model):
+    """Swap GPT-2 style Conv1D layers for equivalent nn.Linear ones so dynamic quantization sees them"""
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if type(child).__name__ == 'Conv1D':
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous())
+                linear.bias = torch.nn.Parameter(child.bias.detach())
+                setattr(parent, name, linear)
+    return model
+
+
+def optimize_model(model, precision: str = 'fp32', compile: bool = False):
+    """Apply the opt-in inference optimizations to a loaded model.
+
+    `precision` casts the weights to bf16/fp16, or quantizes every linear layer to int8
+    weights with dynamically quantized activations (CPU only). `compile` wraps the forward
+    pass in `torch.compile`; shapes change with every batch, so it is compiled dynamically.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {', '.join(PRECISIONS)}")
+    if precision == 'int8':
+        model = torch.ao.quantization.quantize_dynamic(_conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
+    elif precision != 'fp32':
+        model = model.to(PRECISIONS[precision])
+    if compile:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+def get_model(model_id: str = MODEL_ID, num_threads: Optional[int] = None, precision: str = MODEL_PRECISION,
+              compile: bool = MODEL_COMPILE) -> ModelHandle:
+    """Load `model_id` (hub id or local checkpoint path) once per process and return the shared handle.
+
+    Every (model_id, precision, compile) combination is loaded separately, so a baseline
+    fp32 handle can be kept next to an optimized one.
+    """
+    key = (model_id, precision, compile)
+    with _handles_lock:
+        if key not in _handles:
+            threads = num_threads or TORCH_NUM_THREADS
+            if threads:
+                torch.set_num_threads(int(threads))
+
+            print(f"Loading model {model_id} ({precision}{', compiled' if compile else ''})...")
+            start = time.perf_counter()
+            with span('model_load'):
+                model = AutoModelForCausalLM.from_pretrained(model_id, local_files_only=os.path.isdir(model_id))
+                model.eval()
+                tokenizer = load_tokenizer(model_id)
+                vocab = VocabularyFilter(tokenizer, model.config.vocab_size)
+            handle = ModelHandle(model_id, optimize_model(model, precision, compile), tokenizer, vocab, precision,
+                                 context=ContextWindow.for_model(model.config))
+            try:
+                warm_up(handle)
+            except Exception as e:
+                if not compile:
+                    raise
+                # torch.compile needs a working compiler toolchain; run eagerly without one
+                print(f"torch.compile failed ({e}), running {model_id} eagerly")
+                vars(handle.model).pop('forward', None)
+                warm_up(handle)
+            print(f"Model {model_id} ready in {time.perf_counter() - start:.1f}s")
+            _handles[key] = handle
+        return _handles[key]
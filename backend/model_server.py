@@ -0,0 +1,198 @@
+"""Standalone inference server: the one process that holds torch and the CLMBR weights.
+
+    MODEL_SERVER_AUTHKEY=... python model_server.py --address localhost:6001 --window-ms 10
+
+The API (and any number of its workers) sends requests through `model_client.ModelClient`
+instead of loading the model itself. Requests that arrive within `--window-ms` of each
+other are coalesced: simulations with the same search parameters become one cohort
+search, whose levels share forward passes across patients, and next-event predictions for
+many histories become one batched pass. Identical patients in a window are only
+simulated once.
+"""
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import Future
+from multiprocessing.connection import Listener
+from multiprocessing import AuthenticationError
+import argparse
+import json
+import queue
+import threading
+import time
+from result_cache import deserialize_paths, serialize_paths, simulation_key
+from model_client import MODEL_SERVER, MODEL_SERVER_AUTHKEY, parse_address, require_authkey
+from model_registry import MODEL_ID, MODEL_PRECISION, PRECISIONS, ModelHandle, get_model
+from climbr_branching import apply_extension, root_path, run_cohort_simulation, score_frontier
+from distribution_cache import distribution_cache
+from sampling import run_monte_carlo_simulation
+
+DEFAULT_ADDRESS = 'localhost:6001'
+# Fields every request of an op has to carry, with their types
+OPS = {
+    'simulate': {'patients': dict, 'search': dict},
+    'predict': {'patients': list, 'n_tokens': int},
+    'sample': {'initial_patient': list, 'params': dict},
+    'extend': {'tree': bytes, 'search': dict, 'extension': dict},
+}
+
+
+def check_request(request) -> str:
+    """The request's op, or ValueError when it isn't a well-formed request"""
+    if not isinstance(request, dict) or request.get('op') not in OPS:
+        op = request.get('op') if isinstance(request, dict) else None
+        raise ValueError(f"Unknown op {op!r}")
+    for field, field_type in OPS[request['op']].items():
+        if not isinstance(request.get(field), field_type):
+            raise ValueError(f"{request['op']} request needs a {field_type.__name__} {field!r}")
+    return request['op']
+
+
+class ModelServer:
+    """Runs queued requests on one model, a coalesced batch at a time"""
+    def __init__(self, handle: ModelHandle, window: float = 0.01, batch_size: int = 64):
+        self.handle = handle
+        self.window = window
+        self.batch_size = batch_size
+        self.queue: 'queue.Queue[Tuple[Dict, Future]]' = queue.Queue()
+        self.counts = {'requests': 0, 'batches': 0, 'coalesced': 0}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, request: Dict) -> Future:
+        check_request(request)
+        future = Future()
+        self.queue.put((request, future))
+        return future
+
+    def _run(self):
+        while True:
+            jobs = [self.queue.get()]
+            # Give concurrent requests a moment to join this batch
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups: Dict[Tuple, List[Tuple[Dict, Future]]] = {}
+            for request, future in jobs:
+                try:
+                    key = self._group_key(request, future)
+                except Exception as e:
+                    future.set_exception(e)  # Only this request fails
+                    continue
+                groups.setdefault(key, []).append((request, future))
+            for (op, _), group in groups.items():
+                self.counts['requests'] += len(group)
+                self.counts['batches'] += 1
+                self.counts['coalesced'] += len(group) - 1
+                try:
+                    results = getattr(self, f'_{op}')([request for request, _ in group])
+                    for (_, future), result in zip(group, results):
+                        future.set_result(result)
+                except Exception as e:
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+
+    @staticmethod
+    def _group_key(request: Dict, future: Future) -> Tuple:
+        """Requests with the same key run together"""
+        op = request.get('op')
+        if op == 'simulate':
+            return op, json.dumps(request['search'], sort_keys=True)
+        if op == 'predict':
+            return op, None
+        return op, id(future)  # Runs on its own
+
+    def _simulate(self, requests: List[Dict]) -> List[Dict[str, bytes]]:
+        search = requests[0]['search']
+        keys = [{patient_id: simulation_key(events, self.handle.model_id, search, self.handle.precision)
+                 for patient_id, events in request['patients'].items()} for request in requests]
+        patients = {}
+        for request, request_keys in zip(requests, keys):
+            for patient_id, events in request['patients'].items():
+                patients[request_keys[patient_id]] = events
+        results = run_cohort_simulation(patients, handle=self.handle, batch_size=self.batch_size, **search)
+        serialized = {key: serialize_paths(*result) for key, result in results.items()}
+        return [{patient_id: serialized[key] for patient_id, key in request_keys.items()} for request_keys in keys]
+
+    def _predict(self, requests: List[Dict]) -> List[List[List[Tuple[str, float, int]]]]:
+        histories = [events for request in requests for events in request['patients']]
+        n_tokens = max(request['n_tokens'] for request in requests)
+        roots, suffix_ids = [], []
+        for events in histories:
+            root, suffix_ids = root_path(events, self.handle)
+            roots.append(root)
+        predictions = iter(score_frontier(roots, self.handle, suffix_ids, branching=n_tokens,
+                                          batch_size=self.batch_size))
+        return [[next(predictions)[:request['n_tokens']] for _ in request['patients']] for request in requests]
+
+    def _sample(self, requests: List[Dict]) -> List[List[Dict]]:
+        return [run_monte_carlo_simulation(initial_patient=request['initial_patient'], handle=self.handle,
+                                           **request['params'])[0]
+                for request in requests]
+
+    def _extend(self, requests: List[Dict]) -> List[bytes]:
+        trees = []
+        for request in requests:
+            paths, initial_patient = deserialize_paths(request['tree'])
+            paths = apply_extension(paths, initial_patient, request['search'], request['extension'],
+                                    handle=self.handle)
+            trees.append(serialize_paths(paths, initial_patient))
+        return trees
+
+    def stats(self) -> Dict:
+        return dict(self.counts, model_id=self.handle.model_id, precision=self.handle.precision,
+                    window_ms=1000 * self.window, distribution_cache=distribution_cache.stats())
+
+    def serve_connection(self, connection):
+        """Answer one client's requests until it disconnects"""
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if request.get('op') == 'stats':
+                        result = self.stats()
+                    else:
+                        result = self.submit(request).result()
+                    reply = {'result': result}
+                except Exception as e:
+                    reply = {'error': str(e)}
+                connection.send(reply)
+
+    def serve(self, address: str = DEFAULT_ADDRESS, authkey: Optional[bytes] = MODEL_SERVER_AUTHKEY):
+        with Listener(parse_address(address), authkey=require_authkey(authkey)) as listener:
+            print(f"Model server for {self.handle.model_id} listening on {address}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except AuthenticationError as e:
+                    print(f"Rejected connection: {e}")
+                    continue
+                threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve CLMBR model requests for the API's workers")
+    parser.add_argument('--address', default=MODEL_SERVER or DEFAULT_ADDRESS, help="host:port or Unix socket path")
+    parser.add_argument('--model', default=MODEL_ID, help="Hub id or local checkpoint directory")
+    parser.add_argument('--precision', default=MODEL_PRECISION, choices=list(PRECISIONS))
+    parser.add_argument('--threads', type=int, default=None, help="Torch threads")
+    parser.add_argument('--window-ms', type=float, default=10.0, help="How long a batch waits for more requests")
+    parser.add_argument('--batch-size', type=int, default=64, help="Rows per forward pass")
+    args = parser.parse_args()
+    if not MODEL_SERVER_AUTHKEY:
+        parser.error("set MODEL_SERVER_AUTHKEY; clients need the same key")
+
+    handle = get_model(args.model, num_threads=args.threads, precision=args.precision)
+    ModelServer(handle, window=args.window_ms / 1000, batch_size=args.batch_size).serve(args.address)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Spread the branching search over a pool of worker processes.
+
+Each worker loads the model once (see `model_registry.get_model`) with its own torch
+thread count. Work is split in two ways:
+
+- `run_parallel_simulation` grows the first levels of one patient's tree in a single
+  worker, then hands contiguous slices of that frontier (independent subtrees) to the
+  pool. Workers only return their next-event predictions; the parent replays them level
+  by level through `expand_level`, so the merged tree has exactly the path ids, pruning
+  and stopping of `run_branching_simulation`.
+- `run_parallel_cohort` hands whole patients to the pool and merges the trees back
+  through the result cache's serialized form.
+
+Worker processes are spawned (not forked) so they never inherit a half-initialized
+torch thread pool.
+"""
+from hf_ehr.config import Event
+from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import threading
+from apark_timeline import patient2
+from clinical_path import ClinicalPath
+from result_cache import serialize_paths, deserialize_paths
+from token_store import TokenStore, open_store
+from model_registry import MODEL_ID, get_model
+from climbr_branching import check_context, expand_level, grow_level, root_path, run_cohort_simulation, score_frontier
+
+SIMULATION_PROCESSES = int(os.environ.get("SIMULATION_PROCESSES", 1))
+
+# (token id-annotated) steps from the root down to one frontier node
+Chain = List[Tuple[str, str, float, int]]
+Predictions = List[List[Tuple[str, float, int]]]
+
+_pools: Dict[Tuple[str, int, int], ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _init_worker(model_id: str, threads_per_process: int):
+    get_model(model_id, num_threads=threads_per_process)
+
+
+def get_pool(model_id: str = MODEL_ID, processes: int = SIMULATION_PROCESSES,
+             threads_per_process: Optional[int] = None) -> ProcessPoolExecutor:
+    """Shared pool of `processes` workers that each hold `model_id`, created on first use"""
+    threads_per_process = threads_per_process or max(1, (os.cpu_count() or 1) // processes)
+    key = (model_id, processes, threads_per_process)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ProcessPoolExecutor(max_workers=processes,
+                                              mp_context=multiprocessing.get_context('spawn'),
+                                              initializer=_init_worker,
+                                              initargs=(model_id, threads_per_process))
+        return _pools[key]
+
+
+def _check_depth(model_id: str, depth: int):
+    """Worker task: `check_context` against the worker's handle, so this process never loads the model"""
+    check_context(get_model(model_id), depth)
+
+
+def _chain(path: ClinicalPath) -> Chain:
+    """(path_id, token, probability, token_id) for every step of `path`"""
+    return [(node.path_id, node.step['token'], node.step['probability'], node.token_ids[-1])
+            for node in path.lineage()[1:]]
+
+
+def _expand_subtrees(model_id: str, initial_patient: List[Event], chains: List[Chain], level: int, levels: int,
+                     branching: int, min_cum_prob: float, batch_size: Optional[int]) -> List[Predictions]:
+    """Worker task: rebuild the given frontier slice and grow it for `levels` levels.
+
+    Returns the predictions of the slice's open paths for every level, in frontier order.
+    The slice keeps growing even when it alone has nothing new; whether the search
+    stops is decided by the parent for the whole level.
+    """
+    handle = get_model(model_id)
+    root, suffix_ids = root_path(initial_patient, handle)
+    built = {root.path_id: root}
+    current_paths = []
+    for chain in chains:
+        node = root
+        for path_id, token, probability, token_id in chain:
+            if path_id not in built:
+                # Nothing was run for the parent here, so the child runs the whole prefix when scored
+                node = node.branch(path_id, token, probability, token_id)
+                built[path_id] = node
+            node = built[path_id]
+        current_paths.append(node)
+
+    predictions_per_level = []
+    for offset in range(levels):
+        frontier = [path for path in current_paths if not path.diagnosis_found]
+        predictions = score_frontier(frontier, handle, suffix_ids, branching=branching,
+                                     batch_size=batch_size) if frontier else []
+        predictions_per_level.append(predictions)
+        current_paths, _ = grow_level(current_paths, level + offset, handle, suffix_ids, branching=branching,
+                                      min_cum_prob=min_cum_prob, frontier_predictions=predictions)
+    return predictions_per_level
+
+
+def _split(paths: List[ClinicalPath], parts: int) -> List[List[ClinicalPath]]:
+    """Contiguous slices of `paths` with about the same number of open paths each"""
+    open_count = sum(1 for path in paths if not path.diagnosis_found)
+    per_part = max(1, -(-open_count // parts))
+    slices = [[]]
+    seen = 0
+    for path in paths:
+        if not path.diagnosis_found:
+            if seen and seen % per_part == 0:
+                slices.append([])
+            seen += 1
+        slices[-1].append(path)
+    return slices
+
+
+def run_parallel_simulation(depth: int = 4, branching: int = 2, min_cum_prob: float = 0.0,
+                            max_frontier: Optional[int] = None, initial_patient: Optional[List[Event]] = None,
+                            model_id: str = MODEL_ID,
+                            on_level: Optional[Callable[[int, List[ClinicalPath]], None]] = None,
+                            processes: int = SIMULATION_PROCESSES, threads_per_process: Optional[int] = None,
+                            batch_size: Optional[int] = 64):
+    """`run_branching_simulation` with subtrees expanded on `processes` worker processes.
+
+    Returns the same (paths, initial_patient) tree. `on_level` is called once the levels
+    of each phase have been merged.
+    """
+    if max_frontier is not None:
+        raise ValueError("max_frontier ranks the whole level and can't be split across processes")
+    if initial_patient is None:
+        initial_patient = patient2
+    pool = get_pool(model_id, processes, threads_per_process)
+    pool.submit(_check_depth, model_id, depth).result()
+
+    current_paths = [ClinicalPath(initial_patient, "Path-0")]
+    # Grow the top of the tree in one worker until there is a subtree for every process
+    first_levels = 0
+    while first_levels < depth and branching ** first_levels < processes:
+        first_levels += 1
+    phases = [(0, first_levels), (first_levels, depth - first_levels)]
+
+    for start, levels in phases:
+        if levels == 0:
+            continue
+        slices = _split(current_paths, processes)
+        futures = [pool.submit(_expand_subtrees, model_id, initial_patient, [_chain(path) for path in part],
+                               start, levels, branching, min_cum_prob, batch_size)
+                   for part in slices]
+        results = [future.result() for future in futures]
+
+        for offset in range(levels):
+            level = start + offset
+            predictions = [row for result in results for row in result[offset]]
+            next_paths = expand_level(current_paths, level, None, [], branching=branching,
+                                      min_cum_prob=min_cum_prob, frontier_predictions=predictions)
+            if next_paths is current_paths:
+                return current_paths, initial_patient
+            current_paths = next_paths
+            if on_level is not None:
+                on_level(level + 1, current_paths)
+    return current_paths, initial_patient
+
+
+def _simulate_patients(patients, search: Dict, model_id: str, batch_size: Optional[int],
+                       store_directory: Optional[str] = None) -> Dict[str, bytes]:
+    """Worker task: simulate a share of a cohort, returned in the result cache format.
+
+    With a `store_directory`, `patients` is a list of ids read from that token store,
+    which every worker maps once instead of receiving the histories.
+    """
+    store = None
+    if store_directory is not None:
+        store = open_store(store_directory)
+        patients = store.cohort(patients)
+    results = run_cohort_simulation(patients, model_id=model_id, batch_size=batch_size, store=store, **search)
+    return {patient_id: serialize_paths(paths, events) for patient_id, (paths, events) in results.items()}
+
+
+def run_parallel_cohort(patients: Dict[str, List[Event]], depth: int = 4, branching: int = 2,
+                        min_cum_prob: float = 0.0, max_frontier: Optional[int] = None,
+                        model_id: str = MODEL_ID, processes: int = SIMULATION_PROCESSES,
+                        threads_per_process: Optional[int] = None, batch_size: Optional[int] = 64,
+                        store: Optional[TokenStore] = None
+                        ) -> Dict[str, Tuple[List[ClinicalPath], List[Event]]]:
+    """`run_cohort_simulation` with the patients shared out over `processes` worker processes"""
+    pool = get_pool(model_id, processes, threads_per_process)
+    search = {'depth': depth, 'branching': branching, 'min_cum_prob': min_cum_prob, 'max_frontier': max_frontier}
+    patient_ids = list(patients)
+    shares = [patient_ids[i::processes] for i in range(processes) if patient_ids[i::processes]]
+    if store is not None:
+        futures = [pool.submit(_simulate_patients, share, search, model_id, batch_size, store.directory)
+                   for share in shares]
+    else:
+        futures = [pool.submit(_simulate_patients, {patient_id: patients[patient_id] for patient_id in share},
+                               search, model_id, batch_size)
+                   for share in shares]
+    results = {}
+    for future in futures:
+        for patient_id, data in future.result().items():
+            results[patient_id] = deserialize_paths(data)
+    return {patient_id: results[patient_id] for patient_id in patient_ids}
@@ -0,0 +1,218 @@
+from collections import Counter
+from terminology import resolve_token
+import math
+
+
+def _resolve_step(step):
+    """Display fields of one predicted step"""
+    token = step['token']
+    system, code, name = resolve_token(token)
+    return {
+        'token': token,
+        'system': system,
+        'code': name if name is not None else code,  # Default to showing the code
+        'fullcode': code,
+        'probability': step['probability'],
+        'type': step['type']
+    }
+
+
+def _initial_patient_data(initial_patient):
+    initial_data = []
+    for event in initial_patient:
+        system, _, name = resolve_token(event.code)
+        initial_data.append({
+            'code': event.code,
+            'name': name if name is not None else event.code,
+            'system': system,
+            'value': event.value,
+            'omop_table': event.omop_table
+        })
+    return initial_data
+
+
+def build_pathways_payload(current_paths, initial_patient):
+    """Convert the paths to JSON-serializable format, resolving each tree node once"""
+    pathways_data = []
+    resolved_steps = {}  # node id -> step dict, shared by every path through that node
+    for path in current_paths:
+        pathway = {
+            'id': path.path_id,
+            'parent_id': path.parent_id,
+            'diagnosis_found': path.diagnosis_found,
+            'final_diagnosis': path.final_diagnosis,
+            'cumulative_probability': path.cumulative_probability,
+            'steps': []
+        }
+
+        for step in path.steps:
+            if step['node_id'] not in resolved_steps:
+                resolved_steps[step['node_id']] = _resolve_step(step)
+            pathway['steps'].append(resolved_steps[step['node_id']])
+
+        pathways_data.append(pathway)
+
+    return {
+        'initial_patient': _initial_patient_data(initial_patient),
+        'pathways': pathways_data,
+        'total_paths': len(pathways_data),
+        'paths_with_diagnosis': sum(1 for p in pathways_data if p['diagnosis_found'])
+    }
+
+
+def _tree_records(current_paths, initial_patient):
+    """Yield ('header' | 'node' | 'leaf', record) for the normalized tree, nodes parents first"""
+    yield 'header', {
+        'initial_patient': _initial_patient_data(initial_patient),
+        'root_id': current_paths[0].lineage()[0].path_id if current_paths else None,
+        'total_paths': len(current_paths),
+        'paths_with_diagnosis': sum(1 for path in current_paths if path.diagnosis_found),
+    }
+    emitted = set()
+    for path in current_paths:
+        for node in path.lineage():
+            if node.step is None or node.path_id in emitted:
+                continue
+            emitted.add(node.path_id)
+            yield 'node', dict(_resolve_step(node.step), id=node.path_id, parent_id=node.parent_id,
+                               cumulative_probability=node.cumulative_probability)
+    for path in current_paths:
+        yield 'leaf', {
+            'id': path.path_id,
+            'diagnosis_found': path.diagnosis_found,
+            'final_diagnosis': path.final_diagnosis,
+            'cumulative_probability': path.cumulative_probability,
+        }
+
+
+def build_tree_payload(current_paths, initial_patient):
+    """Normalized form of `build_pathways_payload`: every tree node once, linked by parent_id.
+
+    `leaves` lists the pathways in order; a pathway's steps are the nodes on the way from
+    `root_id` (exclusive) down to its leaf.
+    """
+    payload = {'format': 'tree', 'nodes': [], 'leaves': []}
+    for kind, record in _tree_records(current_paths, initial_patient):
+        if kind == 'header':
+            payload.update(record)
+        elif kind == 'node':
+            payload['nodes'].append(record)
+        else:
+            payload['leaves'].append(record)
+    return payload
+
+
+def iter_tree_ndjson(current_paths, initial_patient, dumps):
+    """The tree payload as NDJSON lines, serialized one record at a time: a header line,
+    then one line per node and per leaf, each tagged with its `type`"""
+    for kind, record in _tree_records(current_paths, initial_patient):
+        yield dumps(dict(record, type=kind)) + "\n"
+
+
+def build_predictions_payload(current_paths, initial_patient):
+    """Most frequent codes across all pathways"""
+    # Track unique code positions to avoid double-counting: a step shared by
+    # several paths was introduced by one tree node, so count it once
+    # Key: id of the node that added the step, Value: code
+    unique_code_positions = {}
+
+    for path in current_paths:
+        for step in path.steps:
+            unique_code_positions[step['node_id']] = step['token']
+
+    # Count unique codes
+    code_counter = Counter(unique_code_positions.values())
+    total_positions = len(unique_code_positions)
+
+    # Convert to predictions format
+    predictions = []
+    for code, count in code_counter.most_common(10):
+        percentage = (count / total_positions) * 100
+        system, _, name = resolve_token(code)
+        predictions.append({
+            'name': name if name is not None else code,
+            'probability': round(percentage, 1),
+            'code': code,
+            'system': system,
+            'count': count
+        })
+
+    return {'predictions': predictions}
+
+
+def wilson_interval(count, total, z=1.96):
+    """Wilson score interval for a binomial proportion (95% for the default z)"""
+    if total == 0:
+        return 0.0, 0.0
+    p = count / total
+    denominator = 1 + z * z / total
+    centre = (p + z * z / (2 * total)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denominator
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+
+def _estimate(count, total, **fields):
+    low, high = wilson_interval(count, total)
+    return dict(fields, count=count, probability=count / total if total else 0.0, ci_low=low, ci_high=high)
+
+
+def _sampled_codes(trajectories):
+    """How many trajectories contain each code, most frequent first"""
+    return Counter(code for trajectory in trajectories
+                   for code in set(step['token'] for step in trajectory['steps'])).most_common()
+
+
+def build_sampling_payload(trajectories, initial_patient, top_events=20):
+    """Outcome distribution of Monte Carlo rollouts with 95% Wilson intervals.
+
+    `diagnoses` covers every final diagnosis reached; `no_diagnosis` the trajectories
+    that reached none (`stopped` says why). `events` gives, for the most common codes, the
+    share of trajectories in which they occur at all.
+    """
+    total = len(trajectories)
+    diagnoses = []
+    for token, count in Counter(trajectory['diagnosis'] for trajectory in trajectories
+                                if trajectory['diagnosis'] is not None).most_common():
+        system, code, name = resolve_token(token)
+        diagnoses.append(_estimate(count, total, token=token, system=system,
+                                   code=name if name is not None else code, fullcode=code))
+
+    undiagnosed = [trajectory for trajectory in trajectories if trajectory['diagnosis'] is None]
+    no_diagnosis = _estimate(len(undiagnosed), total,
+                             stopped=dict(Counter(trajectory['stop'] for trajectory in undiagnosed)))
+
+    events = []
+    for token, count in _sampled_codes(trajectories)[:top_events]:
+        system, code, name = resolve_token(token)
+        events.append(_estimate(count, total, token=token, system=system,
+                                code=name if name is not None else code, fullcode=code))
+
+    return {
+        'initial_patient': _initial_patient_data(initial_patient),
+        'samples': total,
+        'mean_length': sum(len(trajectory['steps']) for trajectory in trajectories) / total if total else 0.0,
+        'confidence': 0.95,
+        'diagnoses': diagnoses,
+        'no_diagnosis': no_diagnosis,
+        'events': events,
+    }
+
+
+def build_sampled_predictions_payload(trajectories, initial_patient):
+    """`build_predictions_payload` from rollouts: the share of trajectories containing each code"""
+    total = len(trajectories)
+    predictions = []
+    for code, count in _sampled_codes(trajectories)[:10]:
+        system, _, name = resolve_token(code)
+        low, high = wilson_interval(count, total)
+        predictions.append({
+            'name': name if name is not None else code,
+            'probability': round(100 * count / total, 1),
+            'code': code,
+            'system': system,
+            'count': count,
+            'ci_low': round(100 * low, 1),
+            'ci_high': round(100 * high, 1),
+        })
+
+    return {'predictions': predictions, 'samples': total}
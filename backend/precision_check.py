@@ -0,0 +1,127 @@
+"""Measure how far an optimized model drifts from the fp32 baseline.
+
+    python precision_check.py --precision int8 --compile --inference-mode
+
+Every node of the baseline pathway tree for patient1 and patient2 is scored with both
+models, and the next-event candidates the search would pick are compared: top-k overlap,
+top-1 agreement, probability error on the baseline top-k and KL divergence over the full
+distribution. The trees built by both models are compared as well.
+"""
+from hf_ehr.config import Event
+from typing import Dict, List, Optional
+import argparse
+import copy
+import json
+import time
+import torch
+from apark_timeline import patient2
+from mbishop_timeline import patient1
+from model_registry import MODEL_ID, PRECISIONS, ModelHandle, get_model, inference_context
+from climbr_branching import run_branching_simulation
+
+PATIENTS = {'patient1': patient1, 'patient2': patient2}
+
+
+def next_event_distribution(handle: ModelHandle, events: List[Event]) -> torch.Tensor:
+    """fp32 next-token probabilities after a full (uncached) forward pass"""
+    batch = handle.tokenizer([events], add_special_tokens=True, return_tensors='pt')
+    with inference_context(handle.inference_mode):
+        logits = handle.model(**batch).logits
+    return torch.softmax(logits[0, -1, :].float(), dim=-1)
+
+
+def compare_distributions(baseline: torch.Tensor, candidate: torch.Tensor, mask: torch.Tensor, k: int) -> Dict:
+    """Agreement of the top-k allowed candidates and divergence of two next-token distributions"""
+    base_top = torch.topk(baseline.masked_fill(~mask, -1.0), k)
+    cand_top = torch.topk(candidate.masked_fill(~mask, -1.0), k)
+    base_ids, cand_ids = base_top.indices.tolist(), cand_top.indices.tolist()
+    kl = torch.sum(baseline * (torch.log(baseline.clamp_min(1e-12)) - torch.log(candidate.clamp_min(1e-12))))
+    return {
+        'topk_overlap': len(set(base_ids) & set(cand_ids)) / k,
+        'top1_agree': base_ids[0] == cand_ids[0],
+        'same_order': base_ids == cand_ids,
+        'max_abs_prob_error': (baseline[base_ids] - candidate[base_ids]).abs().max().item(),
+        'max_rel_prob_error': ((baseline[base_ids] - candidate[base_ids]).abs() / baseline[base_ids]).max().item(),
+        'kl_divergence': kl.item(),
+    }
+
+
+def _tree_tokens(paths) -> List[List[str]]:
+    return [[step['token'] for step in path.steps] for path in paths]
+
+
+def check_patient(baseline: ModelHandle, candidate: ModelHandle, events: List[Event], k: int = 10,
+                  depth: int = 4, branching: int = 2) -> Dict:
+    """Compare both models on every node of the baseline tree for one patient"""
+    base_paths, _ = run_branching_simulation(depth=depth, branching=branching, initial_patient=events,
+                                             handle=baseline)
+    cand_paths, _ = run_branching_simulation(depth=depth, branching=branching, initial_patient=events,
+                                             handle=candidate)
+
+    nodes = {}
+    for path in base_paths:
+        for node in path.lineage():
+            nodes[node.path_id] = node
+    contexts = [node.events for node in nodes.values()]
+
+    results = []
+    timings = {'baseline': 0.0, 'candidate': 0.0}
+    for context in contexts:
+        start = time.perf_counter()
+        base_probs = next_event_distribution(baseline, context)
+        timings['baseline'] += time.perf_counter() - start
+        start = time.perf_counter()
+        cand_probs = next_event_distribution(candidate, context)
+        timings['candidate'] += time.perf_counter() - start
+        mask = baseline.vocab.candidate_mask(context)
+        results.append(compare_distributions(base_probs, cand_probs, mask, min(k, int(mask.sum()))))
+
+    base_tree, cand_tree = _tree_tokens(base_paths), _tree_tokens(cand_paths)
+    return {
+        'contexts': len(results),
+        'mean_topk_overlap': sum(r['topk_overlap'] for r in results) / len(results),
+        'top1_agreement': sum(r['top1_agree'] for r in results) / len(results),
+        'same_order': sum(r['same_order'] for r in results) / len(results),
+        'max_abs_prob_error': max(r['max_abs_prob_error'] for r in results),
+        'max_rel_prob_error': max(r['max_rel_prob_error'] for r in results),
+        'mean_kl_divergence': sum(r['kl_divergence'] for r in results) / len(results),
+        'max_kl_divergence': max(r['kl_divergence'] for r in results),
+        'identical_tree': base_tree == cand_tree,
+        'shared_paths': len(set(map(tuple, base_tree)) & set(map(tuple, cand_tree))) / len(base_tree),
+        'forward_ms': {name: 1000 * total / len(contexts) for name, total in timings.items()},
+    }
+
+
+def compare_precisions(model_id: str = MODEL_ID, precision: str = 'int8', compile: bool = False,
+                       inference_mode: bool = False, k: int = 10, depth: int = 4,
+                       patients: Optional[Dict[str, List[Event]]] = None) -> Dict:
+    """Accuracy report for `precision` (and optional compile/inference mode) against fp32"""
+    # Shallow copies with their own inference_mode: the registry hands out one shared handle
+    # per setting (the same one for both with an fp32 candidate), which other callers still use
+    baseline = copy.copy(get_model(model_id, precision='fp32', compile=False))
+    candidate = copy.copy(get_model(model_id, precision=precision, compile=compile))
+    baseline.inference_mode = False
+    candidate.inference_mode = inference_mode
+    report = {'model_id': model_id, 'precision': precision, 'compile': compile,
+              'inference_mode': inference_mode, 'k': k, 'depth': depth, 'patients': {}}
+    for name, events in (patients or PATIENTS).items():
+        report['patients'][name] = check_patient(baseline, candidate, events, k=k, depth=depth)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare an optimized CLMBR model against the fp32 baseline")
+    parser.add_argument('--model', default=MODEL_ID, help="Hub id or local checkpoint directory")
+    parser.add_argument('--precision', default='int8', choices=list(PRECISIONS))
+    parser.add_argument('--compile', action='store_true', help="Run the candidate through torch.compile")
+    parser.add_argument('--inference-mode', action='store_true', help="Score the candidate under torch.inference_mode")
+    parser.add_argument('--k', type=int, default=10, help="Candidates compared per context")
+    parser.add_argument('--depth', type=int, default=4, help="Depth of the pathway trees compared")
+    args = parser.parse_args()
+    report = compare_precisions(args.model, args.precision, compile=args.compile,
+                                inference_mode=args.inference_mode, k=args.k, depth=args.depth)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Lightweight stage timing for the simulator and the API.
+
+`span(stage)` times a block. Every span feeds a process-wide latency histogram (served
+as Prometheus text by /metrics), and, while `start_collecting()` is active in the current
+context (one per Flask request), also that request's per-stage totals.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+import bisect
+import threading
+import time
+
+# Upper bounds in seconds; forward passes land in the middle, cache hits at the bottom
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram in the Prometheus sense"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # Last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class Metrics:
+    """Process-wide counters and histograms, keyed by metric name and label values"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self.help: Dict[str, str] = {}
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1.0):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def observe(self, name: str, seconds: float, labels: Optional[Dict[str, str]] = None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{str(value)}"' for key, value in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(((key, (list(h.counts), h.total, h.count)) for key, h in self.histograms.items()),
+                                key=lambda item: item[0])
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{label_text(labels)} {value:g}")
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{label_text(labels)} {total:.6f}")
+            lines.append(f"{name}_count{label_text(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('climbr_stage_seconds', "Time spent in each simulation and API stage")
+
+_collector: ContextVar[Optional[Dict[str, list]]] = ContextVar('profiling_collector', default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Time the block as `stage`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('climbr_stage_seconds', elapsed, {'stage': stage})
+        stages = _collector.get()
+        if stages is not None:
+            totals = stages.setdefault(stage, [0.0, 0])
+            totals[0] += elapsed
+            totals[1] += 1
+
+
+def start_collecting() -> Tuple[Dict[str, list], object]:
+    """Gather the spans run in this context into a {stage: [seconds, count]} dict until
+    `stop_collecting(token)`; Flask calls this around every request"""
+    stages: Dict[str, list] = {}
+    return stages, _collector.set(stages)
+
+
+def stop_collecting(token):
+    _collector.reset(token)
+
+
+def timing_block(stages: Dict[str, list], total_seconds: float) -> Dict:
+    """The `timing` section of a debug API response"""
+    return {
+        'total_ms': round(1000 * total_seconds, 3),
+        'stages': {stage: {'ms': round(1000 * seconds, 3), 'count': count}
+                   for stage, (seconds, count) in stages.items()},
+    }
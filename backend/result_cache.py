@@ -0,0 +1,183 @@
+from hf_ehr.config import Event
+from typing import Any, Callable, List, Dict, Optional, Tuple
+from collections import OrderedDict
+from pathlib import Path
+from clinical_path import ClinicalPath
+from profiling import span
+from context_window import context_key
+import dataclasses
+import hashlib
+import gzip
+import json
+import os
+import tempfile
+import threading
+
+CACHE_DIR = Path(os.environ.get("PATHWAY_CACHE_DIR", Path(__file__).parent / "pathway_cache"))
+CACHE_MAX_BYTES = int(os.environ.get("PATHWAY_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Bounds of each worker's in-memory caches in front of the on-disk store
+MEMORY_CACHE_RUNS = int(os.environ.get("PATHWAY_MEMORY_CACHE_RUNS", 64))
+MEMORY_CACHE_MAX_BYTES = int(os.environ.get("PATHWAY_MEMORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+def simulation_key(events: List[Event], model_id: str, params: Dict, precision: str = 'fp32') -> str:
+    """Content hash of everything that determines a simulation result"""
+    key = {
+        'events': [dataclasses.asdict(event) for event in events],
+        'model_id': model_id,
+        'params': params,
+    }
+    if precision != 'fp32':
+        key['precision'] = precision  # fp32 keys predate the setting
+    if context_key() is not None:
+        key['context'] = context_key()  # How long histories are cut, when not the default
+    payload = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def serialize_paths(paths: List[ClinicalPath], initial_patient: List[Event]) -> bytes:
+    """Encode a pathway tree as gzipped JSON, storing each shared step once"""
+    nodes = {}
+    leaves = []
+    for path in paths:
+        steps = path.steps
+        for step in steps:
+            nodes[step['node_id']] = [step['token'], step['probability'], step['type']]
+        leaves.append([step['node_id'] for step in steps])
+    payload = {
+        'root_id': paths[0].lineage()[0].path_id if paths else None,
+        'initial_patient': [dataclasses.asdict(event) for event in initial_patient],
+        'nodes': nodes,
+        'paths': leaves,
+    }
+    return gzip.compress(json.dumps(payload, separators=(',', ':'), default=str).encode('utf-8'))
+
+
+def deserialize_paths(data: bytes) -> Tuple[List[ClinicalPath], List[Event]]:
+    """Inverse of `serialize_paths`; the rebuilt paths carry no model state"""
+    payload = json.loads(gzip.decompress(data))
+    initial_patient = [Event(**event) for event in payload['initial_patient']]
+    nodes = payload['nodes']
+    root = ClinicalPath(initial_patient, payload['root_id'])
+    built = {}
+    paths = []
+    for node_ids in payload['paths']:
+        # Rebuild the shared tree: each node is created once, under the previous step's node
+        path = root
+        for node_id in node_ids:
+            if node_id not in built:
+                token, probability, _ = nodes[node_id]
+                built[node_id] = path.branch(node_id, token, probability)
+            path = built[node_id]
+        paths.append(path)
+    return paths, initial_patient
+
+
+class ResultCache:
+    """Content-addressed on-disk store of simulation results with size-bounded LRU eviction.
+
+    Entries are single files written atomically, and a file's mtime is its last use, so
+    several Flask workers can share one directory without coordinating.
+    """
+    def __init__(self, directory: Path = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json.gz"
+
+    def get(self, key: str) -> Optional[Tuple[List[ClinicalPath], List[Event]]]:
+        path = self._path(key)
+        with span('cache_read'):
+            try:
+                data = path.read_bytes()
+                os.utime(path)  # Mark as recently used
+            except FileNotFoundError:
+                return None
+            try:
+                return deserialize_paths(data)
+            except (OSError, EOFError, ValueError, KeyError, TypeError):
+                # Truncated or outdated entry: drop it and treat it as a miss, so it gets recomputed
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                return None
+
+    def put(self, key: str, paths: List[ClinicalPath], initial_patient: List[Event]):
+        with span('cache_write'):
+            data = serialize_paths(paths, initial_patient)
+            fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_name, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the store fits in `max_bytes`"""
+        entries = []
+        for path in self.directory.glob('*.json.gz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # Removed by another worker
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class MemoryLRU:
+    """Thread-safe in-memory LRU map holding at most `max_entries` values, and (when
+    given `size`, e.g. `len` for response bodies) at most `max_bytes` of them"""
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 size: Optional[Callable[[Any], int]] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = size
+        self.entries: 'OrderedDict[Any, Any]' = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = value
+            if self.size is not None:
+                self.total_bytes += self.size(value)
+            while self.entries and (
+                    (self.max_entries is not None and len(self.entries) > self.max_entries)
+                    or (self.max_bytes is not None and self.size is not None and self.total_bytes > self.max_bytes)):
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        value = self.entries.pop(key)
+        if self.size is not None:
+            self.total_bytes -= self.size(value)
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
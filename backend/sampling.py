@@ -0,0 +1,126 @@
+"""Monte Carlo rollouts: estimate outcome probabilities by sampling many trajectories.
+
+The branching search only follows the top candidates, so it says which pathways are
+likely but not how likely each final diagnosis is. Here every trajectory samples its next
+event from the masked next-token distribution until it reaches a `condition_occurrence`
+diagnosis or `max_length` events. All open trajectories of a chunk advance together as
+one batched forward pass per step on top of the patient's cached history; since every
+row adds exactly one event per step, the batch needs no padding.
+"""
+from hf_ehr.config import Event
+from typing import Dict, List, Optional, Tuple
+import torch
+from apark_timeline import patient2
+from clinical_path import omop_table_for
+from profiling import span
+from model_registry import MODEL_ID, ModelHandle, get_model, inference_context
+from climbr_branching import _as_legacy_cache, _model_inputs, check_context, root_path, score_paths
+
+# Why a trajectory ended
+STOP_DIAGNOSIS = 'diagnosis'
+STOP_MAX_LENGTH = 'max_length'
+STOP_EXHAUSTED = 'exhausted'  # No allowed code left to sample
+
+
+def _expand_cache(cache, rows: int):
+    """Share a single-row cache across `rows` rows without copying it"""
+    return tuple(tuple(t.expand(rows, *t.shape[1:]) for t in layer) for layer in cache)
+
+
+def _step(cache, tokens: torch.Tensor, handle: ModelHandle, suffix_ids: List[int]):
+    """Run one sampled token per row on top of `cache`; returns (probabilities, new cache)"""
+    rows = tokens.shape[0]
+    cache_length = cache[0][0].shape[-2]
+    input_ids = torch.cat([tokens.unsqueeze(-1), torch.tensor([suffix_ids], dtype=torch.long).expand(rows, -1)],
+                          dim=-1)
+    position_ids = torch.arange(cache_length, cache_length + input_ids.shape[-1]).expand(rows, -1)
+    attention_mask = torch.ones(rows, cache_length + input_ids.shape[-1], dtype=torch.long)
+    with inference_context(handle.inference_mode):
+        with span('forward'):
+            outputs = handle.model(**_model_inputs(input_ids, handle.tokenizer), attention_mask=attention_mask,
+                                   position_ids=position_ids, past_key_values=cache, use_cache=True)
+        with span('kv_cache'):
+            # Keep the new token, drop the trailing special tokens
+            cache = tuple(tuple(t[..., :cache_length + 1, :] for t in layer)
+                          for layer in _as_legacy_cache(outputs.past_key_values))
+        with span('softmax'):
+            probs = torch.softmax(outputs.logits[:, -1, :].float(), dim=-1)
+    return probs, cache
+
+
+def _rollout_chunk(rows: int, root_probs: torch.Tensor, root_cache, root_mask: torch.Tensor,
+                   handle: ModelHandle, suffix_ids: List[int], max_length: int, temperature: float,
+                   generator: torch.Generator) -> List[Dict]:
+    """Sample `rows` trajectories together"""
+    vocab = handle.vocab
+    trajectories = [{'steps': [], 'diagnosis': None, 'stop': STOP_MAX_LENGTH} for _ in range(rows)]
+    active = list(range(rows))  # Trajectory index of every batch row
+    probs = root_probs.unsqueeze(0).expand(rows, -1)
+    cache = _expand_cache(root_cache, rows)
+    masks = root_mask.unsqueeze(0).repeat(rows, 1)
+
+    for length in range(max_length):
+        with span('sample'):
+            weights = probs.masked_fill(~masks, 0.0)
+            if temperature != 1.0:
+                weights = weights.pow(1.0 / temperature)
+            exhausted = weights.sum(dim=-1) <= 0
+            weights[exhausted] = 1.0  # Sampled but discarded below
+            tokens = torch.multinomial(weights, 1, generator=generator).squeeze(-1)
+
+            keep = []
+            for row, (trajectory_idx, token_id) in enumerate(zip(active, tokens.tolist())):
+                trajectory = trajectories[trajectory_idx]
+                if exhausted[row]:
+                    trajectory['stop'] = STOP_EXHAUSTED
+                    continue
+                token_text = vocab.id_to_text[token_id]
+                omop_table = omop_table_for(token_text)
+                trajectory['steps'].append({'token': token_text, 'probability': probs[row, token_id].item(),
+                                            'type': omop_table})
+                if omop_table == 'condition_occurrence':
+                    trajectory['diagnosis'] = token_text
+                    trajectory['stop'] = STOP_DIAGNOSIS
+                    continue
+                masks[row, vocab.ids_for_code(token_text)] = False  # Like candidate_mask for the new event
+                keep.append(row)
+
+        if not keep or length == max_length - 1:
+            break
+        keep_rows = torch.tensor(keep, dtype=torch.long)
+        active = [active[row] for row in keep]
+        masks = masks.index_select(0, keep_rows)
+        cache = tuple(tuple(t.index_select(0, keep_rows) for t in layer) for layer in cache)
+        probs, cache = _step(cache, tokens.index_select(0, keep_rows), handle, suffix_ids)
+    return trajectories
+
+
+def run_monte_carlo_simulation(n_samples: int = 256, max_length: int = 8, temperature: float = 1.0,
+                               seed: int = 0, batch_size: int = 256,
+                               initial_patient: Optional[List[Event]] = None, model_id: str = MODEL_ID,
+                               handle: Optional[ModelHandle] = None) -> Tuple[List[Dict], List[Event]]:
+    """Sample `n_samples` trajectories for the patient, `batch_size` at a time.
+
+    Returns ([{'steps', 'diagnosis', 'stop'}], initial_patient); each step carries the
+    model's probability of the sampled event. Codes already in a trajectory are masked
+    out like in the branching search, and `temperature` sharpens (< 1) or flattens (> 1)
+    the distribution. Results are reproducible for a given `seed`.
+    """
+    if handle is None:
+        handle = get_model(model_id)
+    if initial_patient is None:
+        initial_patient = patient2
+    check_context(handle, max_length)
+
+    # The history runs through the model once; every chunk starts from its cache
+    root, suffix_ids = root_path(initial_patient, handle)
+    root_probs = score_paths([root], handle.model, handle.tokenizer, suffix_ids, handle.inference_mode)[0]
+    root_mask = handle.vocab.candidate_mask(initial_patient)
+
+    generator = torch.Generator().manual_seed(seed)
+    trajectories = []
+    for start in range(0, n_samples, batch_size):
+        rows = min(batch_size, n_samples - start)
+        trajectories.extend(_rollout_chunk(rows, root_probs, root.past_key_values, root_mask, handle,
+                                           suffix_ids, max_length, temperature, generator))
+    return trajectories, initial_patient
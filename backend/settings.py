@@ -0,0 +1,10 @@
+"""Model settings shared by the app, the batch CLI and the model registry.
+
+Kept free of torch so the app can read them (they are part of every result cache key)
+without loading the model.
+"""
+import os
+
+MODEL_ID = os.environ.get("CLMBR_MODEL_ID", "YaHi/gpt_clmbr")
+# Opt-in inference optimizations; check their divergence with precision_check.py first
+MODEL_PRECISION = os.environ.get("CLMBR_PRECISION", "fp32")  # fp32 | bf16 | fp16 | int8
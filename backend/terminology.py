@@ -0,0 +1,102 @@
+from typing import Dict, Optional, Tuple
+from functools import lru_cache
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from profiling import span
+
+# Source vocabularies, indexed once into a SQLite file and looked up per code afterwards
+TERMINOLOGY_SOURCES: Dict[str, str] = {
+    'LOINC': 'loinc.json',
+    'CPT4': 'cpt4.json',
+    'SNOMED': 'snomed.json',
+}
+TERMINOLOGY_DB = os.environ.get("TERMINOLOGY_DB", "terminology.sqlite")
+
+_local = threading.local()
+_build_lock = threading.Lock()
+
+
+def _source_name(system: str, entry) -> Optional[str]:
+    """Display name for one JSON entry"""
+    if system == 'LOINC':
+        return entry["DisplayName"] or entry["LONG_COMMON_NAME"]
+    return entry
+
+
+def _is_stale(db_path: str) -> bool:
+    if not os.path.exists(db_path):
+        return True
+    built = os.path.getmtime(db_path)
+    return any(os.path.exists(source) and os.path.getmtime(source) > built
+               for source in TERMINOLOGY_SOURCES.values())
+
+
+def build_index(db_path: str = TERMINOLOGY_DB):
+    """Index every source vocabulary into `db_path`.
+
+    The file is written next to its destination and swapped in atomically, so workers
+    that are already reading the old index are not disturbed.
+    """
+    directory = os.path.dirname(os.path.abspath(db_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.sqlite.tmp')
+    os.close(fd)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("CREATE TABLE terms (system TEXT, code TEXT, name TEXT, PRIMARY KEY (system, code)) WITHOUT ROWID")
+        for system, source in TERMINOLOGY_SOURCES.items():
+            if not os.path.exists(source):
+                print(f"Terminology source {source} not found, {system} codes will show raw")
+                continue
+            with open(source, "r") as f:
+                entries = json.load(f)
+            conn.executemany(
+                "INSERT OR REPLACE INTO terms VALUES (?, ?, ?)",
+                ((system, code, _source_name(system, entry)) for code, entry in entries.items()),
+            )
+            del entries
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+
+
+def _connection() -> sqlite3.Connection:
+    """Per-thread read-only connection, building the index first if it is missing or stale"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        with _build_lock:
+            if _is_stale(TERMINOLOGY_DB):
+                build_index(TERMINOLOGY_DB)
+        conn = sqlite3.connect(f"file:{os.path.abspath(TERMINOLOGY_DB)}?mode=ro", uri=True)
+        _local.conn = conn
+    return conn
+
+
+@lru_cache(maxsize=65536)
+def display_name(system: str, code: str) -> Optional[str]:
+    """Human-readable name for a code, or None when the terminology doesn't know it"""
+    row = _connection().execute("SELECT name FROM terms WHERE system = ? AND code = ?", (system, code)).fetchone()
+    return row[0] if row else None
+
+
+@lru_cache(maxsize=65536)
+def resolve_token(token: str) -> Tuple[str, str, Optional[str]]:
+    """Split a token such as 'LOINC/8480-6 || mmHg || 80 - 200' into (system, code, display name).
+
+    `code` is everything after the system; the display name is looked up on the bare code
+    and is None when the terminology doesn't know it.
+    """
+    if '/' not in token:
+        return 'Unknown', token, None
+    system, code = token.split('/', 1)
+    code_only = code.split(" ")[0].split('/')[-1]
+    with span('terminology'):
+        return system, code, display_name(system, code_only)
+
+
+if __name__ == '__main__':
+    build_index(TERMINOLOGY_DB)
+    print(f"Indexed terminologies into {TERMINOLOGY_DB}")
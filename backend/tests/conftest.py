@@ -0,0 +1,36 @@
+"""Shared fixtures: the backend modules are imported flat, like the app does"""
+from pathlib import Path
+import sys
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope='session')
+def handle(tmp_path_factory):
+    """A small deterministic stand-in model (see benchmark.build_stand_in_model)"""
+    pytest.importorskip('torch')
+    pytest.importorskip('hf_ehr')
+    from benchmark import build_stand_in_model
+    from model_registry import get_model
+
+    directory = str(tmp_path_factory.mktemp('model'))
+    build_stand_in_model(directory, n_codes=300, n_layer=2, n_embd=32)
+    return get_model(directory)
+
+
+@pytest.fixture(autouse=True)
+def no_memo(monkeypatch):
+    """Every score comes from the model, not from predictions memoized by an earlier test"""
+    from distribution_cache import distribution_cache
+    monkeypatch.setattr(distribution_cache, 'max_entries', 0)
+
+
+@pytest.fixture
+def memo(no_memo, monkeypatch):
+    """The next-event prediction memo switched back on, starting empty"""
+    from distribution_cache import distribution_cache
+    distribution_cache.clear()
+    monkeypatch.setattr(distribution_cache, 'max_entries', 100_000)
+    yield distribution_cache
+    distribution_cache.clear()
@@ -0,0 +1,94 @@
+"""Incremental scoring must give what full forward passes give.
+
+The engine runs each path's new tokens on top of left-padded, per-row cached prefixes,
+packs several patients into one batch and grows stored trees in place; all of that is
+checked here against plain, one-sequence-at-a-time runs of the stand-in model.
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from apark_timeline import patient2
+from mbishop_timeline import patient1
+from clinical_path import release_model_state
+from result_cache import deserialize_paths, serialize_paths
+from climbr_branching import (_model_inputs, _restore_model_state, deepen_tree, root_path, run_branching_simulation,
+                              run_cohort_simulation, score_paths, widen_tree)
+
+ATOL = 1e-5
+
+
+def full_probs(handle, path, suffix_ids):
+    """Next-token probabilities from one uncached forward pass over the path's whole sequence"""
+    ids = [token_id for node in path.lineage() for token_id in node.token_ids] + suffix_ids
+    with torch.no_grad():
+        logits = handle.model(**_model_inputs(torch.tensor([ids]), handle.tokenizer)).logits
+    return torch.softmax(logits[0, -1].float(), dim=-1)
+
+
+def shape(paths):
+    """Node ids and tokens of every path, in order"""
+    return [[(step['node_id'], step['token']) for step in path.steps] for path in paths]
+
+
+def probabilities(paths):
+    return torch.tensor([path.cumulative_probability for path in paths], dtype=torch.float64)
+
+
+def test_batched_cached_scores_match_full_forward(handle):
+    paths, _ = run_branching_simulation(depth=3, branching=2, initial_patient=patient2, handle=handle)
+    _, suffix_ids = root_path(patient2, handle)
+    # Leaves still hold their parent's cache; a rebuilt copy of the tree has none, so one
+    # batch mixes rows of different cache lengths with rows that run their whole sequence
+    rebuilt, _ = deserialize_paths(serialize_paths(paths, patient2))
+    root, _ = root_path(patient2, handle)
+    _restore_model_state(rebuilt[:1], handle, root.token_ids, root.sequence_hash)
+    batch = paths[::2] + [rebuilt[0], paths[0].parent]
+
+    expected = torch.stack([full_probs(handle, path, suffix_ids) for path in batch])
+    scored = score_paths(batch, handle.model, handle.tokenizer, suffix_ids)
+    assert torch.allclose(scored, expected, atol=ATOL)
+
+    # The trimmed caches left behind serve the next tokens just as well
+    children = [path.branch(f"{path.path_id}-x", handle.vocab.id_to_text[token_id], 1.0, token_id)
+                for path, token_id in zip(batch, scored.argmax(dim=-1).tolist())]
+    expected = torch.stack([full_probs(handle, child, suffix_ids) for child in children])
+    assert torch.allclose(score_paths(children, handle.model, handle.tokenizer, suffix_ids), expected, atol=ATOL)
+
+
+def test_cohort_trees_match_single_patient_trees(handle):
+    patients = {'a': patient1, 'b': patient2, 'c': patient2[:5]}
+    cohort = run_cohort_simulation(patients, depth=3, branching=2, handle=handle, batch_size=5)
+    for patient_id, events in patients.items():
+        single, _ = run_branching_simulation(depth=3, branching=2, initial_patient=events, handle=handle)
+        paths, initial_patient = cohort[patient_id]
+        assert initial_patient == events
+        assert shape(paths) == shape(single)
+        assert torch.allclose(probabilities(paths), probabilities(single), atol=ATOL)
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_deepen_by_one_matches_deeper_search(handle, cached):
+    paths, _ = run_branching_simulation(depth=2, branching=2, initial_patient=patient2, handle=handle)
+    if cached:
+        paths, _ = deserialize_paths(serialize_paths(paths, patient2))  # No model state, like the result cache
+    deepened = deepen_tree(paths, patient2, levels=1, branching=2, handle=handle)
+    deeper, _ = run_branching_simulation(depth=3, branching=2, initial_patient=patient2, handle=handle)
+    assert [path.path_id for path in deepened] == [path.path_id for path in deeper]
+    assert shape(deepened) == shape(deeper)
+    assert torch.allclose(probabilities(deepened), probabilities(deeper), atol=ATOL)
+
+
+def test_widen_then_deepen_numbers_nodes_uniquely(handle):
+    paths, _ = run_branching_simulation(depth=2, branching=2, initial_patient=patient2, handle=handle)
+    release_model_state(paths)
+    paths = widen_tree(paths, patient2, 'Path-1-0', extra=1, handle=handle)
+    paths = deepen_tree(paths, patient2, levels=1, node_id='Path-1-0', handle=handle)
+    nodes = {}
+    for path in paths:
+        for step in path.steps:
+            nodes.setdefault(step['node_id'], step['token'])
+            assert nodes[step['node_id']] == step['token']  # One id, one node
+    assert len(set(path.path_id for path in paths)) == len(paths)
+    assert 'Path-2-4' in nodes  # The widened child comes after the search's Path-2-0 … Path-2-3
+    assert any(node_id.startswith('Path-3-') for node_id in nodes)
@@ -0,0 +1,106 @@
+"""Histories longer than the model's context are cut to the window's budget, whatever the strategy"""
+import copy
+import dataclasses
+import pytest
+
+from hf_ehr.config import Event
+from context_window import STRATEGIES, ContextWindow
+
+
+class EveryEventTokenizer:
+    """Stands in for a tokenizer that gives each event one token"""
+    all_special_ids = [0, 1]
+
+
+def timeline(length, conditions=()):
+    """`length` events a minute apart; those at the `conditions` indices are diagnoses"""
+    return [Event(code=f"SNOMED/{idx}", start=f"2024-01-{1 + idx // 1440:02d}T{idx // 60 % 24:02d}:{idx % 60:02d}:00",
+                  omop_table='condition_occurrence' if idx in conditions else 'observation')
+            for idx in range(length)]
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_select_keeps_at_most_the_budget(strategy):
+    window = ContextWindow(max_tokens=30, strategy=strategy, reserve=10, days=1)
+    events = timeline(100, conditions=(3, 50))
+    kept = window.select(events, EveryEventTokenizer())
+    assert 0 < len(kept) <= window.budget
+    assert [events.index(event) for event in kept] == sorted(events.index(event) for event in kept)
+    assert window.select(events[:window.budget], EveryEventTokenizer()) == events[:window.budget]
+
+
+def test_strategies_keep_what_they_promise():
+    events = timeline(3000, conditions=(3, 50))
+    recent = ContextWindow(max_tokens=30, strategy='recent', reserve=10).select(events, EveryEventTokenizer())
+    assert recent == events[-20:]
+    conditions = ContextWindow(max_tokens=30, strategy='conditions', reserve=10).select(events, EveryEventTokenizer())
+    assert conditions == [events[3], events[50]] + events[-18:]
+    # Events more than a day before the latest one go first, even when the rest would fit
+    window = ContextWindow(max_tokens=3000, strategy='time', reserve=10, days=1)
+    kept = window.select(events, EveryEventTokenizer())
+    assert kept == events[3000 - 1441:]
+
+
+def test_cap_keeps_leading_special_tokens():
+    window = ContextWindow(max_tokens=30, reserve=10)
+    capped = window.cap([0, 1] + list(range(100, 150)), EveryEventTokenizer())
+    assert len(capped) == window.budget
+    assert capped == [0, 1] + list(range(132, 150))
+    assert window.cap([0, 1, 100], EveryEventTokenizer()) == [0, 1, 100]
+
+
+@pytest.fixture(scope='module')
+def short_model(tmp_path_factory):
+    """A stand-in model with only 128 positions, and the codes its vocabulary holds"""
+    pytest.importorskip('torch')
+    from benchmark import build_stand_in_model
+    from model_registry import get_model
+
+    directory = str(tmp_path_factory.mktemp('short_model'))
+    codes = build_stand_in_model(directory, n_codes=300, n_layer=2, n_embd=32, n_positions=128)
+    return get_model(directory), codes
+
+
+def with_window(handle, **settings):
+    """A copy of `handle` with its own context window"""
+    handle = copy.copy(handle)
+    handle.context = ContextWindow(handle.context.max_tokens, **settings)
+    return handle
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_search_runs_on_histories_longer_than_the_model(short_model, strategy):
+    from benchmark import synthetic_timeline
+    from climbr_branching import fit_history, run_branching_simulation
+
+    base, codes = short_model
+    handle = with_window(base, strategy=strategy, reserve=16, days=0.1)
+    events = synthetic_timeline(codes, 500)
+    events = [dataclasses.replace(event, omop_table='condition_occurrence') if idx % 40 == 0 else event
+              for idx, event in enumerate(events)]
+    history_ids, _, report = fit_history(events, handle.tokenizer, handle.context)
+    assert len(history_ids) <= handle.context.budget
+    assert report['truncated'] and report['tokens_kept'] == len(history_ids)
+
+    paths, _ = run_branching_simulation(depth=3, branching=2, initial_patient=events, handle=handle)
+    assert len(paths) == 8
+    assert all(len(path.steps) == 3 for path in paths)
+
+
+def test_special_tokens_pushing_a_fitting_history_over_drop_an_event(short_model):
+    from benchmark import synthetic_timeline
+    from climbr_branching import fit_history
+
+    base, codes = short_model
+    handle = with_window(base, reserve=64)
+    # One event token short of the budget: only the leading special tokens push it over
+    events = synthetic_timeline(codes, 2 * handle.context.budget)
+    events = events[-(handle.context.budget - 1):]
+    assert handle.context.count_tokens(events, handle.tokenizer) == handle.context.budget - 1
+    history_ids, _, report = fit_history(events, handle.tokenizer, handle.context)
+    specials = len(history_ids) - handle.context.count_tokens(events[len(events) - report['events_kept']:],
+                                                             handle.tokenizer)
+    assert specials > 1
+    assert len(history_ids) <= handle.context.budget
+    assert report['truncated']
+    assert report['events_kept'] == handle.context.budget - specials
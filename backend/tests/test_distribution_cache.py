@@ -0,0 +1,80 @@
+"""Trees built from memoized predictions must match trees scored by the model alone.
+
+Memo hits skip the forward pass, so the nodes below them have to run every token their
+ancestors never ran; and a memo entry may only answer for the same history and the same
+candidate filter.
+"""
+import copy
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from hf_ehr.config import Event
+from apark_timeline import patient2
+from context_window import ContextWindow
+from climbr_branching import deepen_tree, root_path, run_branching_simulation
+
+ATOL = 1e-5
+
+SEARCHES = [(2, 2), (3, 2), (2, 3), (3, 3)]
+
+
+def shape(paths):
+    return [[(step['node_id'], step['token']) for step in path.steps] for path in paths]
+
+
+def probabilities(paths):
+    return torch.tensor([path.cumulative_probability for path in paths], dtype=torch.float64)
+
+
+def assert_same_tree(paths, expected):
+    assert shape(paths) == shape(expected)
+    assert torch.allclose(probabilities(paths), probabilities(expected), atol=ATOL)
+
+
+def test_memoized_searches_match_model_searches(handle, request):
+    expected = {search: run_branching_simulation(depth=search[0], branching=search[1], initial_patient=patient2,
+                                                 handle=handle)[0]
+                for search in SEARCHES}
+    memo = request.getfixturevalue('memo')
+    # Deeper after shallower reuses every node above the new level; wider asks for more
+    # candidates than the entries hold
+    for depth, branching in SEARCHES:
+        paths, _ = run_branching_simulation(depth=depth, branching=branching, initial_patient=patient2,
+                                            handle=handle)
+        assert_same_tree(paths, expected[depth, branching])
+    assert memo.hits > 0
+
+    shallow, _ = run_branching_simulation(depth=2, branching=2, initial_patient=patient2, handle=handle)
+    assert_same_tree(deepen_tree(shallow, patient2, levels=1, branching=2, handle=handle), expected[3, 2])
+
+    # Too small for the whole tree: the root was evicted and reruns, some of its children
+    # are hits, so their children run on top of a cache that is more than one token behind
+    memo.clear()
+    memo.max_entries = 2
+    run_branching_simulation(depth=2, branching=2, initial_patient=patient2, handle=handle)
+    hits = memo.hits
+    paths, _ = run_branching_simulation(depth=3, branching=2, initial_patient=patient2, handle=handle)
+    assert memo.hits > hits
+    assert_same_tree(paths, expected[3, 2])
+
+
+def test_truncated_histories_with_different_dropped_codes_dont_share_entries(handle, request):
+    # A window that keeps only the end of patient2, so a leading event is always dropped
+    small = copy.copy(handle)
+    small.context = ContextWindow(max_tokens=19, reserve=8)
+    filler = Event(code='SNOMED/0000', omop_table='observation')
+    kept, _ = root_path([filler] + patient2, small)
+    expected, _ = run_branching_simulation(depth=1, branching=1, initial_patient=[filler] + patient2, handle=small)
+    # The other patient's dropped event is that prediction, which their candidate filter excludes
+    top_code = expected[0].steps[0]['token'].split(' || ')[0]
+    other = [Event(code=top_code, omop_table='measurement')] + patient2
+    other_root, _ = root_path(other, small)
+    assert other_root.token_ids == kept.token_ids
+    assert other_root.sequence_hash != kept.sequence_hash
+
+    request.getfixturevalue('memo')
+    other_paths, _ = run_branching_simulation(depth=1, branching=1, initial_patient=other, handle=small)
+    assert other_paths[0].steps[0]['token'].split(' || ')[0] != top_code
+    paths, _ = run_branching_simulation(depth=1, branching=1, initial_patient=[filler] + patient2, handle=small)
+    assert_same_tree(paths, expected)
@@ -0,0 +1,32 @@
+"""Damaged on-disk entries are misses that get recomputed, not errors"""
+from hf_ehr.config import Event
+from clinical_path import ClinicalPath
+from result_cache import ResultCache
+
+
+def small_tree():
+    initial_patient = [Event(code='SNOMED/1')]
+    root = ClinicalPath(initial_patient, "Path-0")
+    return [root.branch("Path-1", 'LOINC/2', 0.5), root.branch("Path-2", 'RxNorm/3', 0.25)], initial_patient
+
+
+def test_truncated_entry_is_dropped(tmp_path):
+    cache = ResultCache(tmp_path)
+    paths, initial_patient = small_tree()
+    cache.put('key', paths, initial_patient)
+    entry = tmp_path / 'key.json.gz'
+    data = entry.read_bytes()
+    entry.write_bytes(data[:len(data) // 2])
+
+    assert cache.get('key') is None
+    assert not entry.exists()
+    cache.put('key', paths, initial_patient)
+    cached_paths, _ = cache.get('key')
+    assert [path.steps for path in cached_paths] == [path.steps for path in paths]
+
+
+def test_undecodable_entry_is_dropped(tmp_path):
+    cache = ResultCache(tmp_path)
+    (tmp_path / 'key.json.gz').write_bytes(b'not gzip')
+    assert cache.get('key') is None
+    assert not (tmp_path / 'key.json.gz').exists()
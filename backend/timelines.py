@@ -0,0 +1,109 @@
+from hf_ehr.config import Event
+from typing import Dict, Iterator, List, Tuple
+from pathlib import Path
+import csv
+import dataclasses
+import json
+
+EVENT_FIELDS = set(field.name for field in dataclasses.fields(Event))
+
+
+def events_from_json(raw_events: List[dict]) -> List[Event]:
+    """Build Events from dicts with the Event fields (code, value, unit, start, end, omop_table)"""
+    if not isinstance(raw_events, list):
+        raise ValueError(f"Expected a list of events, got {type(raw_events).__name__}")
+    events = []
+    for raw in raw_events:
+        if not isinstance(raw, dict) or 'code' not in raw:
+            raise ValueError(f"Event without a code: {raw}")
+        events.append(Event(**{key: value for key, value in raw.items() if key in EVENT_FIELDS}))
+    return events
+
+
+def parse_cohort(data, default_id: str = 'patient') -> Dict[str, List[Event]]:
+    """Accept the cohort shapes we support and return {patient_id: events}.
+
+    - a list of event dicts (a single patient, named `default_id`)
+    - {patient_id: [event dicts]}
+    - a list of {"patient_id": ..., "events": [event dicts]}
+    - {"patients": <any of the above>}
+    """
+    if isinstance(data, dict) and 'patients' in data:
+        data = data['patients']
+    if isinstance(data, dict):
+        return {str(patient_id): events_from_json(events) for patient_id, events in data.items()}
+    if isinstance(data, list) and all(isinstance(item, dict) and 'events' in item for item in data) and data:
+        cohort = {}
+        for idx, item in enumerate(data):
+            cohort[str(item.get('patient_id', idx))] = events_from_json(item['events'])
+        return cohort
+    if isinstance(data, list):
+        return {default_id: events_from_json(data)}
+    raise ValueError("Expected a list of events, a {patient_id: events} mapping or a list of patient records")
+
+
+def _omop_value(raw: str):
+    if raw in (None, ''):
+        return None
+    try:
+        return float(raw)
+    except ValueError:
+        return raw
+
+
+def iter_omop_csv(path: str) -> Iterator[Tuple[str, List[Event]]]:
+    """Stream (patient_id, events) from a flat OMOP-style CSV export, one patient at a time.
+
+    Columns: person_id, code (or vocabulary_id and concept_code), value (or
+    value_as_number / value_as_string), unit, start, end and omop_table; only person_id
+    and the code are required. Rows must be grouped by person_id and in time order per
+    person, as an export sorted by (person_id, start) is.
+    """
+    seen = set()
+    patient_id, events = None, []
+    with open(path, "r", newline='') as f:
+        for row_no, row in enumerate(csv.DictReader(f), start=2):
+            code = row.get('code') or (f"{row['vocabulary_id']}/{row['concept_code']}"
+                                       if row.get('vocabulary_id') and row.get('concept_code') else None)
+            if not code:
+                raise ValueError(f"{path}:{row_no}: row without a code")
+            if row['person_id'] != patient_id:
+                if patient_id is not None:
+                    yield patient_id, events
+                patient_id, events = row['person_id'], []
+                if patient_id in seen:
+                    raise ValueError(f"{path}:{row_no}: rows of person {patient_id} aren't contiguous")
+                seen.add(patient_id)
+            value = row.get('value')
+            if value in (None, ''):
+                value = row.get('value_as_number') or row.get('value_as_string')
+            events.append(Event(code=code, value=_omop_value(value), unit=row.get('unit') or None,
+                                start=row.get('start') or None, end=row.get('end') or None,
+                                omop_table=row.get('omop_table') or None))
+    if patient_id is not None:
+        yield patient_id, events
+
+
+def iter_timelines(path: str) -> Iterator[Tuple[str, List[Event]]]:
+    """Stream (patient_id, events) from any input `load_timelines` reads; .jsonl and .csv
+    files are read one patient at a time"""
+    path = Path(path)
+    if path.suffix == '.csv':
+        yield from iter_omop_csv(path)
+    elif path.suffix == '.jsonl':
+        with open(path, "r") as f:
+            for line_no, line in enumerate(f):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                yield str(record.get('patient_id', f"{path.stem}-{line_no}")), events_from_json(record['events'])
+    else:
+        with open(path, "r") as f:
+            yield from parse_cohort(json.load(f), default_id=path.stem).items()
+
+
+def load_timelines(path: str) -> Dict[str, List[Event]]:
+    """Read a cohort from a .json file (any shape `parse_cohort` accepts), a .jsonl file
+    with one {"patient_id": ..., "events": [...]} record per line or an OMOP-style .csv
+    export (see `iter_omop_csv`)"""
+    return dict(iter_timelines(path))
@@ -0,0 +1,188 @@
+"""Pre-tokenized patient timelines, memory-mapped at read time.
+
+    python token_store.py build store/ cohort.jsonl export.csv --model YaHi/gpt_clmbr
+    python token_store.py info store/
+
+Ingestion tokenizes every patient once and writes a flat int32 token array plus per-patient
+offsets (and the distinct codes of each patient, which candidate filtering needs). Inputs
+are streamed one patient at a time, so exports larger than memory are fine. Readers map
+the arrays instead of loading them: a patient's history is a slice of the mapped file,
+there are no per-event Python objects, and worker processes share the pages.
+"""
+from hf_ehr.config import Event
+from typing import Dict, Iterable, List, Optional, Tuple
+from functools import lru_cache
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+STORE_VERSION = 1
+
+
+def build_store(patients: Iterable[Tuple[str, List[Event]]], directory: str, tokenizer, model_id: str) -> Dict:
+    """Tokenize `patients` into a new store at `directory` (replacing any store there); returns its index"""
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=directory.parent, prefix=f".{directory.name}-"))
+    patient_ids: List[str] = []
+    code_table: Dict[str, int] = {}
+    offsets, code_offsets = [0], [0]
+    suffix_ids: Optional[List[int]] = None
+    n_events = 0
+    try:
+        with open(tmp_dir / 'tokens.i32', 'wb') as tokens_file, open(tmp_dir / 'codes.i32', 'wb') as codes_file:
+            for patient_id, events in patients:
+                input_ids = tokenizer([events], add_special_tokens=True)['input_ids'][0]
+                if input_ids and input_ids[-1] == tokenizer.eos_token_id:
+                    input_ids, patient_suffix = input_ids[:-1], input_ids[-1:]
+                else:
+                    patient_suffix = []
+                suffix_ids = patient_suffix if suffix_ids is None else suffix_ids
+                codes = list(dict.fromkeys(event.code for event in events))
+                np.asarray(input_ids, dtype=np.int32).tofile(tokens_file)
+                np.asarray([code_table.setdefault(code, len(code_table)) for code in codes],
+                           dtype=np.int32).tofile(codes_file)
+                patient_ids.append(str(patient_id))
+                offsets.append(offsets[-1] + len(input_ids))
+                code_offsets.append(code_offsets[-1] + len(codes))
+                n_events += len(events)
+        if len(set(patient_ids)) != len(patient_ids):
+            raise ValueError("Duplicate patient ids in the store inputs")
+        np.asarray(offsets, dtype=np.int64).tofile(tmp_dir / 'offsets.i64')
+        np.asarray(code_offsets, dtype=np.int64).tofile(tmp_dir / 'code_offsets.i64')
+        index = {
+            'version': STORE_VERSION,
+            'model_id': model_id,
+            'vocab_size': len(tokenizer),
+            'suffix_ids': suffix_ids or [],
+            'patient_ids': patient_ids,
+            'codes': list(code_table),
+            'events': n_events,
+            'tokens': offsets[-1],
+        }
+        with open(tmp_dir / 'index.json', 'w') as f:
+            json.dump(index, f)
+        if directory.exists():
+            shutil.rmtree(directory)
+        os.replace(tmp_dir, directory)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return index
+
+
+def _map(path: Path, dtype) -> np.ndarray:
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)  # mmap can't map an empty file
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class TokenStore:
+    """Read-only view of a store written by `build_store`"""
+    def __init__(self, directory: str):
+        self.directory = str(directory)
+        path = Path(directory)
+        with open(path / 'index.json') as f:
+            self.index = json.load(f)
+        if self.index.get('version') != STORE_VERSION:
+            raise ValueError(f"{directory} is a version {self.index.get('version')} token store, "
+                             f"expected {STORE_VERSION}")
+        self.tokens = _map(path / 'tokens.i32', np.int32)
+        self.offsets = _map(path / 'offsets.i64', np.int64)
+        self.codes = _map(path / 'codes.i32', np.int32)
+        self.code_offsets = _map(path / 'code_offsets.i64', np.int64)
+        self.patient_ids: List[str] = self.index['patient_ids']
+        self.suffix_ids: List[int] = self.index['suffix_ids']
+        self.model_id: str = self.index['model_id']
+        self._rows = {patient_id: row for row, patient_id in enumerate(self.patient_ids)}
+
+    def __len__(self) -> int:
+        return len(self.patient_ids)
+
+    def __contains__(self, patient_id: str) -> bool:
+        return patient_id in self._rows
+
+    def _row(self, patient_id: str) -> int:
+        if patient_id not in self._rows:
+            raise KeyError(f"Patient {patient_id} isn't in the token store {self.directory}")
+        return self._rows[patient_id]
+
+    def history_ids(self, patient_id: str) -> np.ndarray:
+        """The patient's tokenized history without the trailing special tokens; a view of the mapped file"""
+        row = self._row(patient_id)
+        return self.tokens[self.offsets[row]:self.offsets[row + 1]]
+
+    def patient_codes(self, patient_id: str) -> List[str]:
+        row = self._row(patient_id)
+        return [self.index['codes'][idx] for idx in self.codes[self.code_offsets[row]:self.code_offsets[row + 1]]]
+
+    def events(self, patient_id: str) -> List[Event]:
+        """One code-only Event per distinct code of the patient: what candidate filtering and
+        the payloads' initial patient need, without rebuilding the timeline"""
+        return [Event(code=code) for code in self.patient_codes(patient_id)]
+
+    def cohort(self, patient_ids: Optional[Iterable[str]] = None) -> Dict[str, List[Event]]:
+        if patient_ids is None:
+            patient_ids = self.patient_ids
+        return {patient_id: self.events(patient_id) for patient_id in patient_ids}
+
+    def digest(self, patient_id: str) -> str:
+        """Content hash of the patient's tokens, for result cache keys"""
+        return hashlib.blake2b(self.history_ids(patient_id).tobytes(), digest_size=16).hexdigest()
+
+    def check(self, handle):
+        """Refuse a model whose vocabulary the store wasn't tokenized with"""
+        if self.index['vocab_size'] != len(handle.tokenizer):
+            raise ValueError(f"Token store {self.directory} was built for {self.model_id} "
+                             f"({self.index['vocab_size']} tokens), not {handle.model_id}")
+
+
+@lru_cache(maxsize=None)
+def open_store(directory: str) -> TokenStore:
+    """One shared `TokenStore` per directory and process"""
+    return TokenStore(directory)
+
+
+def main():
+    from model_registry import MODEL_ID, load_tokenizer
+    from timelines import iter_timelines
+
+    parser = argparse.ArgumentParser(description="Build or inspect a pre-tokenized patient timeline store")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="Tokenize timelines into a new store")
+    build.add_argument('directory')
+    build.add_argument('inputs', nargs='+', help=".json, .jsonl or OMOP-style .csv timelines")
+    build.add_argument('--model', default=MODEL_ID, help="Hub id or local checkpoint directory")
+    info = commands.add_parser('info', help="Summarize a store")
+    info.add_argument('directory')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        tokenizer = load_tokenizer(args.model)
+        start = time.perf_counter()
+        patients = ((patient_id, events) for path in args.inputs for patient_id, events in iter_timelines(path))
+        index = build_store(patients, args.directory, tokenizer, args.model)
+        print(f"Stored {len(index['patient_ids'])} patients, {index['events']} events as {index['tokens']} tokens "
+              f"in {time.perf_counter() - start:.1f}s")
+    else:
+        store = TokenStore(args.directory)
+        lengths = np.diff(store.offsets)
+        print(json.dumps({
+            'model_id': store.model_id,
+            'patients': len(store),
+            'events': store.index['events'],
+            'tokens': int(store.index['tokens']),
+            'distinct_codes': len(store.index['codes']),
+            'max_history_tokens': int(lengths.max()) if len(lengths) else 0,
+            'mean_history_tokens': float(lengths.mean()) if len(lengths) else 0.0,
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,21 +10,44 @@ function App() {
   const [error, setError] = useState(null);
 
   useEffect(() => {
-    // Fetch pathway data from Flask backend
+    let source;
+
+    // Start the simulation as a background job and render each tree level as it streams in
     const fetchData = async () => {
       try {
         setLoading(true);
         
-        // Get pathways
-        const pathwaysResponse = await axios.get('http://localhost:5000/api/pathways');
-        
-        setPathwayData(pathwaysResponse.data);
-        
-        // Get predictions
-        const predictionsResponse = await axios.get('http://localhost:5000/api/predictions');
-        setPredictions(predictionsResponse.data.predictions);
-        
-        setLoading(false);
+        // Trees come normalized (each node once); PathwayVisualization rebuilds the paths
+        const jobResponse = await axios.post('http://localhost:5000/api/jobs?format=tree');
+        source = new EventSource(`http://localhost:5000${jobResponse.data.stream_url}`);
+
+        source.addEventListener('level', (event) => {
+          setPathwayData(JSON.parse(event.data));
+          setLoading(false);
+        });
+
+        source.addEventListener('done', async () => {
+          source.close();
+          try {
+            // Both responses are cached by the backend once the job is done
+            const pathwaysResponse = await axios.get('http://localhost:5000/api/pathways?format=tree');
+            setPathwayData(pathwaysResponse.data);
+
+            const predictionsResponse = await axios.get('http://localhost:5000/api/predictions');
+            setPredictions(predictionsResponse.data.predictions);
+          } catch (err) {
+            console.error('Error fetching data:', err);
+            setError(err.message);
+          }
+          setLoading(false);
+        });
+
+        // Fired for a failed job (with data) and for a dropped connection (without)
+        source.addEventListener('error', (event) => {
+          source.close();
+          setError(event.data ? JSON.parse(event.data).error : 'Lost connection to the simulation');
+          setLoading(false);
+        });
       } catch (err) {
         console.error('Error fetching data:', err);
         setError(err.message);
@@ -33,6 +56,7 @@ function App() {
     };
 
     fetchData();
+    return () => source && source.close();
   }, []);
 
   if (loading) {
@@ -61,7 +85,8 @@ function App() {
     <div className="App">
       <PathwayVisualization 
         pathwayData={pathwayData} 
-        predictions={predictions}
+        predictions={predictions || []}
+        simulating={predictions === null}
       />
     </div>
   );
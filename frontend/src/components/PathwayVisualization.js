@@ -1,9 +1,44 @@
-import React, { useState } from 'react';
+import React, { useMemo, useState } from 'react';
 import { ChevronRight, Activity, Pill, Stethoscope, Beaker, AlertCircle, TrendingUp, GitBranch } from 'lucide-react';
 
-const PathwayVisualization = ({ pathwayData, predictions }) => {
+// Rebuild the flat pathway list from the backend's normalized tree (?format=tree):
+// each node is sent once with a parent pointer, so a path's steps are its ancestors
+export const pathwaysFromTree = (tree) => {
+  const nodes = {};
+  tree.nodes.forEach((node) => { nodes[node.id] = node; });
+
+  const stepsCache = {};
+  const stepsFor = (id) => {
+    if (!nodes[id]) return [];
+    if (!stepsCache[id]) {
+      const { token, system, code, fullcode, probability, type, parent_id } = nodes[id];
+      stepsCache[id] = [...stepsFor(parent_id), { token, system, code, fullcode, probability, type }];
+    }
+    return stepsCache[id];
+  };
+
+  const pathways = tree.leaves.map((leaf) => ({
+    ...leaf,
+    parent_id: nodes[leaf.id] ? nodes[leaf.id].parent_id : null,
+    steps: stepsFor(leaf.id)
+  }));
+
+  return {
+    initial_patient: tree.initial_patient,
+    pathways,
+    total_paths: tree.total_paths,
+    paths_with_diagnosis: tree.paths_with_diagnosis,
+    level: tree.level
+  };
+};
+
+const PathwayVisualization = ({ pathwayData: rawPathwayData, predictions, simulating = false }) => {
   const [selectedPath, setSelectedPath] = useState(0);
   const [hoveredEvent, setHoveredEvent] = useState(null);
+  const pathwayData = useMemo(
+    () => (rawPathwayData && rawPathwayData.format === 'tree' ? pathwaysFromTree(rawPathwayData) : rawPathwayData),
+    [rawPathwayData]
+  );
 
   // Color scheme for different code systems
   const codeColors = {
@@ -48,6 +83,12 @@ const PathwayVisualization = ({ pathwayData, predictions }) => {
         <div className="text-center mb-8">
           <h1 className="text-3xl font-bold text-gray-800 mb-2">Clinical Pathway Prediction</h1>
           <div className="mt-4 flex justify-center gap-6 text-sm">
+            {simulating && (
+              <span className="flex items-center text-blue-600">
+                <span className="animate-spin rounded-full h-4 w-4 border-b-2 border-blue-600 mr-2"></span>
+                Simulating… {pathwayData.level ? `level ${pathwayData.level} complete` : ''}
+              </span>
+            )}
           </div>
         </div>
 